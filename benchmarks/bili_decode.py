@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# Replays synthetic danmaku traffic through the old and the new bilibili packet
+# decoder and reports messages per second.
+#
+#   python benchmarks/bili_decode.py [--messages N] [--batch N] [--chunk BYTES]
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timelapse.bilibili import (
+    BILI_PACKET_HEADER,
+    BiliPacketDecoder,
+    bili_encode_packet,
+    bili_packet_cmd,
+    brotli,
+)
+
+def encode(protocol: int, operation: int, body: bytes) -> bytes:
+    # bili_encode_packet always sets protocol 1, the server sends json as 0
+    # and compressed batches as 2 or 3
+    return BILI_PACKET_HEADER.pack(len(body) + 16, 16, protocol, operation, 0) + body
+
+def danmaku_message(i: int) -> bytes:
+    return json.dumps({
+        'cmd': 'DANMU_MSG',
+        'info': [
+            [0, 1, 25, 16777215, 1600000000000 + i, random.randrange(1 << 31), 0, 'abcdef01', 0, 0, 0],
+            'message number %d %s' % (i, 'w' * random.randrange(4, 40)),
+            [random.randrange(1 << 30), 'user%d' % random.randrange(10000), 0, 0, 0, 10000, 1, ''],
+            [12, 'medal', 'streamer', 21452505, 6126494, '', 0],
+            [21, 0, 5805790, '>50000'],
+            ['title-131-1', 'title-131-1'],
+            0, 0, None,
+            {'ts': 1600000000 + i, 'ct': 'ABCDEF0123456789'},
+        ],
+    }, ensure_ascii=False).encode('utf8')
+
+def build_traffic(messages: int, batch: int, compress) -> bytes:
+    random.seed(0)
+    traffic = [bili_encode_packet(8, b'{"code":0}')]
+    for start in range(0, messages, batch):
+        nested = b''.join(encode(0, 5, danmaku_message(i)) for i in range(start, min(start + batch, messages)))
+        protocol, payload = compress(nested)
+        traffic.append(encode(protocol, 5, payload))
+        traffic.append(encode(1, 3, struct.pack('>I', 1000)))  # popularity, as the heartbeat reply
+    return b''.join(traffic)
+
+def chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def old_decode_packet(buf):
+    # the decoder before the memoryview rewrite, kept here for comparison
+    packet_len, unk1, protocol, operation, unk2 = struct.unpack('>IHHII', buf[:16])
+    data = buf[16:]
+    if protocol == 0:
+        data = json.loads(data)
+    elif protocol == 1 and len(data) == 4:
+        data = struct.unpack('>I', data)
+    elif protocol == 2:
+        data = zlib.decompress(data)
+    return protocol, operation, data
+
+def run_old(traffic) -> int:
+    count = 0
+    buffer = b''
+    for chunk in traffic:
+        buffer += chunk
+        while True:
+            if len(buffer) < 16:
+                break
+            packet_len, = struct.unpack('>I', buffer[:4])
+            if len(buffer) < packet_len:
+                break
+            packet_buf = buffer[:packet_len]
+            buffer = buffer[packet_len:]
+            proto, op, data = old_decode_packet(packet_buf)
+            if proto == 2:
+                buffer = data + buffer
+                continue
+            if op == 5:
+                data['cmd']
+                count += 1
+    return count
+
+def run_new(traffic) -> int:
+    count = 0
+    decoder = BiliPacketDecoder()
+    for chunk in traffic:
+        decoder.feed(chunk)
+        for proto, op, data in decoder.packets():
+            if op == 5:
+                bili_packet_cmd(data)
+                count += 1
+    return count
+
+def measure(name: str, run, traffic, messages: int, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = run(traffic)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert count == messages, f'{name} decoded {count} of {messages} messages'
+    print(f'{name:<24} {messages / best:>12,.0f} messages/s')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=20, help='messages per compressed packet')
+    parser.add_argument('--chunk', type=int, default=4096, help='bytes per socket read')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    zlib_traffic = chunks(build_traffic(args.messages, args.batch, lambda data: (2, zlib.compress(data))), args.chunk)
+    print(f'{args.messages} messages in batches of {args.batch}, {args.chunk} byte reads')
+    measure('old decoder, zlib', run_old, zlib_traffic, args.messages, args.repeat)
+    measure('new decoder, zlib', run_new, zlib_traffic, args.messages, args.repeat)
+    if brotli:
+        brotli_traffic = chunks(build_traffic(args.messages, args.batch, lambda data: (3, brotli.compress(data))), args.chunk)
+        print(f'wire size: zlib {sum(map(len, zlib_traffic))} bytes, brotli {sum(map(len, brotli_traffic))} bytes')
+        measure('new decoder, brotli', run_new, brotli_traffic, args.messages, args.repeat)
+    else:
+        print('brotli is not installed, skipping protover 3')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Compares the objectpath queries the channel watcher used to run on a ?pbj=1
+# channel payload with youtube_extract_channel, per poll CPU time and peak memory.
+#
+#   python benchmarks/channel_extract.py [--payload FILE] [--videos N]
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import objectpath
+
+from timelapse.youtube import youtube_extract_channel
+
+def video_renderer(i: int, style: str):
+    return {'gridVideoRenderer': {
+        'videoId': f'video{i:06d}',
+        'thumbnail': {'thumbnails': [
+            {'url': f'https://i.ytimg.com/vi/video{i:06d}/{size}.jpg', 'width': width, 'height': height}
+            for size, width, height in (('default', 120, 90), ('mqdefault', 320, 180), ('hqdefault', 480, 360))
+        ]},
+        'title': {'runs': [{'text': f'Stream number {i}'}], 'accessibility': {'accessibilityData': {'label': f'Stream number {i}'}}},
+        'publishedTimeText': {'simpleText': f'{i} days ago'},
+        'viewCountText': {'simpleText': f'{i * 17} views'},
+        'navigationEndpoint': {'commandMetadata': {'webCommandMetadata': {'url': f'/watch?v=video{i:06d}'}}},
+        'ownerBadges': [{'metadataBadgeRenderer': {'icon': {'iconType': 'CHECK_CIRCLE_THICK'}, 'style': 'BADGE_STYLE_TYPE_VERIFIED'}}],
+        'trackingParams': 'x' * 40,
+        'thumbnailOverlays': [
+            {'thumbnailOverlayTimeStatusRenderer': {'text': {'simpleText': '1:00:00'}, 'style': style}},
+            {'thumbnailOverlayNowPlayingRenderer': {'text': {'runs': [{'text': 'Now playing'}]}}},
+        ],
+    }}
+
+def synthetic_payload(videos: int):
+    # roughly the shape of a channel page, a few live/upcoming streams among the uploads
+    styles = ['LIVE', 'UPCOMING', 'UPCOMING'] + ['DEFAULT'] * (videos - 3)
+    return [
+        {'page': 'channel', 'csn': 'x'},
+        {'response': {
+            'contents': {'twoColumnBrowseResultsRenderer': {'tabs': [
+                {'tabRenderer': {'title': 'Home', 'content': {'sectionListRenderer': {'contents': [
+                    {'itemSectionRenderer': {'contents': [{'shelfRenderer': {'content': {'horizontalListRenderer': {
+                        'items': [video_renderer(i, style) for i, style in enumerate(styles[j::4])],
+                    }}}}]}}
+                    for j in range(4)
+                ]}}}},
+            ]}},
+            'metadata': {'channelMetadataRenderer': {'title': 'Channel', 'description': 'd' * 2000}},
+        }},
+    ]
+
+def extract_objectpath(channel_data):
+    # what YoutubeChannelWatcher.poll did before youtube_extract_channel
+    optree = objectpath.Tree(channel_data)
+    name = next(optree.execute('$..channelMetadataRenderer.title'))
+    videos = list(itertools.chain(
+        optree.execute('$..*["LIVE" in @.thumbnailOverlays..style]'),
+        optree.execute('$..*["UPCOMING" in @.thumbnailOverlays..style]'),
+    ))
+    return name, videos
+
+def extract_single_pass(channel_data):
+    return youtube_extract_channel(channel_data)
+
+def measure(name: str, extract, channel_data, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        result = extract(channel_data)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    extract(channel_data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    title, videos = result
+    print(f'{name:<16} {best * 1000:>9.2f} ms cpu/poll {peak / 1024:>10.1f} KiB peak  ({len(videos)} videos, title {title!r})')
+    return sorted(video['videoId'] for video in videos)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payload', help='saved ?pbj=1 channel response, synthetic if not given')
+    parser.add_argument('--videos', type=int, default=60, help='videos in the synthetic payload')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.payload:
+        with open(args.payload) as f:
+            channel_data = json.load(f)
+    else:
+        channel_data = synthetic_payload(args.videos)
+    print(f'payload: {len(json.dumps(channel_data))} bytes of json')
+    old = measure('objectpath', extract_objectpath, channel_data, args.repeat)
+    new = measure('single pass', extract_single_pass, channel_data, args.repeat)
+    assert old == new, 'extractors disagree on the live/upcoming videos'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# Measures what `import timelapse` costs and what the first use of each
+# downloader backend adds on top, each in a fresh interpreter.
+#
+#   python benchmarks/import_cost.py [--repeat N] [--importtime]
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# code run after `import timelapse` to load a backend
+BACKENDS = {
+    'all exports': 'from timelapse import *',
+    'streamlink': 'from timelapse.downloader import _get_streamlink; _get_streamlink()',
+    'youtube-dl': 'import youtube_dl',
+    'you-get': 'import you_get.common, you_get.extractors',
+    'hls': 'from timelapse.downloader import get_downloader; get_downloader("hls")',
+    'magic': 'import magic',
+}
+
+PROBE = '''
+import json, resource, sys, time
+def rss():
+    # kilobytes on linux, bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+rss_start = rss()
+start = time.perf_counter()
+import timelapse
+import_time = time.perf_counter() - start
+rss_import = rss()
+start = time.perf_counter()
+exec(sys.argv[1])
+use_time = time.perf_counter() - start
+print(json.dumps([import_time, rss_import - rss_start, use_time, rss() - rss_import, rss()]))
+'''
+
+def probe(code: str):
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE, code],
+        cwd=ROOT, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    ).stdout
+    return json.loads(out)
+
+def best_of(code: str, repeat: int):
+    results = [probe(code) for _ in range(repeat)]
+    return [min(result[i] for result in results) for i in range(5)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--importtime', action='store_true', help='also print the slowest modules of -X importtime')
+    args = parser.parse_args()
+
+    import_time, import_rss, _, _, total_rss = best_of('pass', args.repeat)
+    print(f'{"import timelapse":<24} {import_time * 1000:>8.1f} ms {import_rss:>8} KiB rss  ({total_rss} KiB max rss)')
+    for name, code in BACKENDS.items():
+        try:
+            _, _, use_time, use_rss, total_rss = best_of(code, args.repeat)
+        except subprocess.CalledProcessError:
+            print(f'{"first use of " + name:<24} not installed')
+            continue
+        print(f'{"first use of " + name:<24} {use_time * 1000:>8.1f} ms {use_rss:>8} KiB rss  ({total_rss} KiB max rss)')
+
+    if args.importtime:
+        stderr = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import timelapse'],
+            cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        ).stderr
+        rows = []
+        for line in stderr.splitlines()[1:]:
+            self_us, cumulative_us, module = line.split('|')
+            rows.append((int(self_us.split(':')[1]), module.rstrip()))
+        print('slowest modules by self time:')
+        for self_us, module in sorted(rows, reverse=True)[:15]:
+            print(f'  {self_us / 1000:>8.1f} ms {module.strip()}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+import http.server
+import json
+import threading
+import time
+import unittest
+import urllib.parse
+
+from timelapse.bilibili import BiliRoomPoller, BilibiliLiveRoomWatcher
+from timelapse.eventloop import EventLoop
+from timelapse.pollschedule import RateBudget
+
+# room id -> uid, room 3 is left out of the batched status answer
+ROOMS = {1: 101, 2: 102, 3: 103}
+MISSING_FROM_STATUS = {103}
+
+class BiliStandInHandler(http.server.BaseHTTPRequestHandler):
+    # GET /info?room_id=<id> stands in for getInfoByRoom, POST /status for get_status_info_by_uids
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        room_id = int(urllib.parse.parse_qs(url.query)['room_id'][0])
+        self.log_request_body('GET', url.path, room_id)
+        self.reply(200, {'code': 0, 'data': {
+            'room_info': {'uid': ROOMS[room_id], 'title': f'info {room_id}', 'live_status': 0, 'live_start_time': 0},
+            'anchor_info': {'base_info': {'uname': f'user {room_id}'}},
+        }})
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.log_request_body('POST', self.path, body['uids'])
+        if self.server.fail_status:
+            self.reply(500, None)
+            return
+        self.reply(200, {'code': 0, 'data': {
+            str(uid): {'uname': f'user {uid}', 'title': f'status {uid}', 'live_status': 0, 'live_time': 0}
+            for uid in body['uids'] if uid not in MISSING_FROM_STATUS
+        }})
+    def log_request_body(self, method: str, path: str, arg):
+        with self.server.lock:
+            self.server.requests.append((method, path, arg))
+    def reply(self, status: int, data):
+        body = json.dumps(data).encode() if data is not None else b'internal error'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if data is not None else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+class BiliRoomPollerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = EventLoop('test-bili-poller')
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.stop()
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BiliStandInHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.fail_status = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    def poller(self, **kwargs) -> BiliRoomPoller:
+        kwargs.setdefault('debounce', 0.2)
+        return BiliRoomPoller(
+            loop=self.loop,
+            room_info_url=self.base_url + '/info?room_id={room_id}',
+            status_url=self.base_url + '/status',
+            **kwargs,
+        )
+    def watchers(self, poller: BiliRoomPoller, room_ids):
+        return [
+            BilibiliLiveRoomWatcher(room_id, '/nonexistent', loop=self.loop, poller=poller, autostart=False)
+            for room_id in room_ids
+        ]
+    def requests(self, method: str):
+        with self.server.lock:
+            return [request for request in self.server.requests if request[0] == method]
+
+    def test_debounce_collapses_requests(self):
+        poller = self.poller()
+        watchers = self.watchers(poller, (1, 2))
+        for i in range(5):
+            for watcher in watchers:
+                poller.request(watcher)
+        self.assertTrue(wait_for(lambda: all(w.uid for w in watchers)))
+        time.sleep(0.3)
+        self.assertEqual(sorted(arg for _, _, arg in self.requests('GET')), [1, 2])
+        self.assertEqual(poller.requests, 10)
+        self.assertEqual(poller.polled, 2)
+
+    def test_batch_by_uid_and_fallback(self):
+        poller = self.poller()
+        watchers = self.watchers(poller, (1, 2, 3))
+        for watcher in watchers:
+            watcher.schedule_poll()
+        self.assertTrue(wait_for(lambda: all(w.uid and not w.polling for w in watchers)))
+        self.server.requests.clear()
+        for watcher in watchers:
+            watcher.schedule_poll()
+        self.assertTrue(wait_for(lambda: not any(w.polling for w in watchers) and len(self.requests('GET')) == 1))
+        # one POST for all known uids, the uid missing from the answer goes through getInfoByRoom
+        self.assertEqual(self.requests('POST'), [('POST', '/status', [101, 102, 103])])
+        self.assertEqual(self.requests('GET'), [('GET', '/info', 3)])
+        self.assertEqual([w.title for w in watchers], ['status 101', 'status 102', 'info 3'])
+
+    def test_polling_reset_on_failure(self):
+        poller = self.poller()
+        watchers = self.watchers(poller, (1, 2))
+        for watcher in watchers:
+            watcher.schedule_poll()
+        self.assertTrue(wait_for(lambda: all(w.uid and not w.polling for w in watchers)))
+        self.server.fail_status = True
+        for watcher in watchers:
+            watcher.schedule_poll()
+        self.assertTrue(all(w.polling for w in watchers))
+        self.assertTrue(wait_for(lambda: self.requests('POST') and not any(w.polling for w in watchers)))
+        # the rooms can ask again
+        for watcher in watchers:
+            watcher.schedule_poll()
+        self.assertTrue(wait_for(lambda: len(self.requests('POST')) == 2))
+
+    def test_rate_budget_delay(self):
+        budget = RateBudget(2)
+        self.assertEqual(budget.reserve(), 0)
+        self.assertEqual(budget.reserve(), 0)
+        self.assertAlmostEqual(budget.reserve(), 30, delta=0.5)
+        self.assertAlmostEqual(budget.reserve(), 60, delta=0.5)
+        # a budget of one request per minute holds the second room back
+        poller = self.poller(requests_per_minute=1)
+        watchers = self.watchers(poller, (1, 2))
+        for watcher in watchers:
+            watcher.schedule_poll()
+        self.assertTrue(wait_for(lambda: len(self.requests('GET')) == 1))
+        time.sleep(1)
+        self.assertEqual(len(self.requests('GET')), 1)
+        self.assertEqual(sum(1 for w in watchers if w.polling), 1)
+
+if __name__ == '__main__':
+    unittest.main()
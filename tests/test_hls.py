@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+import http.server
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+
+from timelapse.hls import HlsDownloader
+from timelapse.storage import StorageManager
+
+MPEGURL = 'application/vnd.apple.mpegurl'
+
+def vod_segment(variant: str, sequence: int) -> bytes:
+    return f'[{variant}:{sequence}]'.encode()
+
+class HlsStandInHandler(http.server.BaseHTTPRequestHandler):
+    # VOD: /vod/master.m3u8 -> low/high variants of 5 segments, segment 1 is
+    #      slow and segment 3 is missing
+    # live: /live/master hands out a new token per request, /live/<token>/media.m3u8
+    #      is a sliding window of 3 segments that advances every 0.5s
+    # /flv never ends, like the bilibili FLV stream
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        with server.lock:
+            server.requests.append(path)
+        if path == '/vod/master.m3u8':
+            self.reply(MPEGURL, (
+                '#EXTM3U\n'
+                '#EXT-X-STREAM-INF:BANDWIDTH=100000\nlow.m3u8\n'
+                '#EXT-X-STREAM-INF:BANDWIDTH=900000\nhigh.m3u8\n'
+            ))
+        elif path in ('/vod/low.m3u8', '/vod/high.m3u8'):
+            variant = path[5:-5]
+            body = '#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXT-X-MEDIA-SEQUENCE:0\n'
+            body += ''.join(f'#EXTINF:1.0,\n{variant}/{i}.ts\n' for i in range(5))
+            self.reply(MPEGURL, body + '#EXT-X-ENDLIST\n')
+        elif re.fullmatch(r'/vod/(low|high)/\d+\.ts', path):
+            variant, sequence = path[5:-3].split('/')
+            if sequence == '3':
+                self.reply(None, b'', status=404)
+                return
+            if sequence == '1':
+                time.sleep(0.3)  # finishes after the segments queued behind it
+            self.reply('video/mp2t', vod_segment(variant, int(sequence)))
+        elif path == '/live/master':
+            with server.lock:
+                server.token += 1
+                token = server.token
+            self.reply(MPEGURL, f'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=100000\n/live/{token}/media.m3u8\n')
+        elif re.fullmatch(r'/live/\d+/media\.m3u8', path):
+            last = int((time.time() - server.started) / 0.5) + 2
+            body = f'#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXT-X-MEDIA-SEQUENCE:{last - 2}\n'
+            body += ''.join(f'#EXTINF:0.5,\n{i}.ts\n' for i in range(last - 2, last + 1))
+            self.reply(MPEGURL, body)
+        elif re.fullmatch(r'/live/\d+/\d+\.ts', path):
+            token, sequence = path[6:-3].split('/')
+            self.reply('video/mp2t', f'[{sequence}]'.encode())
+        elif path == '/flv':
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/x-flv')
+            self.end_headers()
+            try:
+                while not server.closing:
+                    self.wfile.write(b'\0' * 65536)
+                    time.sleep(0.01)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self.reply(None, b'', status=404)
+    def reply(self, content_type, body, status: int = 200):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+class HlsDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), HlsStandInHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.token = 0
+        self.server.started = time.time()
+        self.server.closing = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storage = StorageManager(reserve_bytes=0, default_bitrate=0)
+    def tearDown(self):
+        self.server.closing = True
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+    def download(self, url: str, **kwargs) -> HlsDownloader:
+        return HlsDownloader(url, self.tmpdir.name, 'out', storage=self.storage, parallel=4, **kwargs)
+    def output(self) -> bytes:
+        with open(os.path.join(self.tmpdir.name, 'out.ts'), 'rb') as f:
+            return f.read()
+
+    def test_vod_variant_order_skip_endlist(self):
+        dl = self.download(self.base_url + '/vod/master.m3u8')
+        dl.wait(10)
+        self.assertFalse(dl.is_running(), 'ENDLIST playlist did not finish the download')
+        self.assertTrue(dl.finished())
+        self.assertTrue(dl.playlist_url.endswith('/vod/high.m3u8'))
+        self.assertNotIn('/vod/low.m3u8', self.server.requests)
+        # segment 1 arrives last but is written second, segment 3 is skipped
+        self.assertEqual(self.output(), b''.join(vod_segment('high', i) for i in (0, 1, 2, 4)))
+        self.assertEqual(dl.written_segments, 4)
+        self.assertEqual(dl.skipped_segments, 1)
+
+    def test_renew_keeps_media_sequence(self):
+        # no .m3u8 suffix, so the page url is resolved through streamlink's hls:// plugin
+        dl = self.download('hls://' + self.base_url + '/live/master')
+        time.sleep(2.5)
+        first_playlist = dl.playlist_url
+        dl.renew()
+        time.sleep(3)
+        dl.interrupt()
+        dl.wait(10)
+        self.assertFalse(dl.is_running())
+        self.assertEqual(dl.renew_count, 1)
+        self.assertNotEqual(dl.playlist_url, first_playlist)
+        self.assertIn(re.sub(r'^https?://[^/]+', '', dl.playlist_url), self.server.requests)
+        sequences = [int(i) for i in re.findall(rb'\[(\d+)\]', self.output())]
+        self.assertGreater(len(sequences), 6)
+        self.assertEqual(sequences, list(range(sequences[0], sequences[0] + len(sequences))))
+
+    def test_non_hls_stream_fails_fast(self):
+        for dl in (
+            # resolved to a streamlink HTTPStream
+            self.download('httpstream://' + self.base_url + '/flv'),
+            # handed over play url, e.g. bilibili durl
+            self.download(self.base_url + '/page', play_url=self.base_url + '/flv'),
+        ):
+            dl.wait(5)
+            self.assertFalse(dl.is_running(), 'endless non-HLS response was read into memory')
+            self.assertFalse(dl.finished())
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, 'out.ts')))
+
+if __name__ == '__main__':
+    unittest.main()
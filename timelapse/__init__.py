@@ -1,7 +1,52 @@
 #!/usr/bin/python3
+import importlib
+
 from .logger import logger
-from .downloader import YtdlDownloader, YouGetDownloader, StreamlinkDownloader
-from .youtube import YoutubeChannelWatcher, YoutubeLivestreamRecorder, YoutubeWebhook
-from .bilibili import BilibiliLiveRoomWatcher
-from .streamurl import StreamUrlWatcher
-from .status import check_status
\ No newline at end of file
+
+# everything else is imported on first access, so that importing the package
+# does not load backends that are never used
+_exports = {
+    'YtdlDownloader': '.downloader',
+    'YouGetDownloader': '.downloader',
+    'StreamlinkDownloader': '.downloader',
+    'register_downloader': '.downloader',
+    'get_downloader': '.downloader',
+    'StreamCache': '.downloader',
+    'configure_stream_cache': '.downloader',
+    'HlsDownloader': '.hls',
+    'YoutubeChannelWatcher': '.youtube',
+    'YoutubeLivestreamRecorder': '.youtube',
+    'YoutubeWebhook': '.youtube',
+    'BilibiliLiveRoomWatcher': '.bilibili',
+    'BiliRoomPoller': '.bilibili',
+    'configure_bili_room_poller': '.bilibili',
+    'StreamUrlWatcher': '.streamurl',
+    'EventLoop': '.eventloop',
+    'get_event_loop': '.eventloop',
+    'set_event_loop_pool_size': '.eventloop',
+    'HttpClient': '.httpclient',
+    'configure_http_client': '.httpclient',
+    'get_http_client': '.httpclient',
+    'set_poll_budget': '.pollschedule',
+    'PostProcessor': '.postprocess',
+    'StorageManager': '.storage',
+    'configure_storage_manager': '.storage',
+    'get_storage_manager': '.storage',
+    'DownloadWorkerPool': '.workerpool',
+    'configure_download_worker_pool': '.workerpool',
+    'StateStore': '.state',
+    'Bootstrap': '.bootstrap',
+    'MetricsServer': '.metrics',
+    'enable_profiling': '.profiling',
+    'disable_profiling': '.profiling',
+    'check_status': '.status',
+}
+
+__all__ = ['logger', *_exports]
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -1,7 +1,5 @@
 #!/usr/bin/python3
 import re
-import requests
-import select
 import socket
 import json
 import struct
@@ -11,15 +9,32 @@ import errno
 import zlib
 import os
 from typing import Optional
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+from . import metrics
 from .logger import logger
-from .downloader import StreamlinkDownloader
+from .downloader import StreamlinkDownloader, downloader_accepts, get_downloader
+from .eventloop import EventLoop, get_event_loop
+from .httpclient import get_http_client
+from .pollschedule import RateBudget
+from .profiling import span
 from .status import status_add_watch
 
 BILI_SOCK_HOST = 'broadcastlv.chat.bilibili.com'
 BILI_SOCK_PORT = 2243
+BILI_CONNECT_TIMEOUT = 10
 BILI_ROOM_URL = 'https://live.bilibili.com/{room_id}'
 BILI_ROOM_INFO_URL = 'https://api.live.bilibili.com/xlive/web-room/v1/index/getInfoByRoom?room_id={room_id}'
+BILI_STATUS_BY_UIDS_URL = 'https://api.live.bilibili.com/room/v1/Room/get_status_info_by_uids'
+BILI_PLAY_URL = 'https://api.live.bilibili.com/room/v1/Room/playUrl?cid={room_id}&quality=4&platform=web'
+BILI_PACKET_HEADER = struct.Struct('>IHHII')
+BILI_PROTOVER = 3 if brotli else 2
+BILI_POLL_CMDS = frozenset(['LIVE', 'ROUND', 'CLOSE', 'PREPARING', 'END', 'ROOM_CHANGE'])
+# only a cmd that is the first key of the message, nested objects may carry a cmd of their own
+BILI_CMD_RE = re.compile(rb'\{\s*"cmd"\s*:\s*"([^"\\]*)"')
 
 class BilibiliLiveRoomWatcher:
     def __init__(
@@ -33,6 +48,10 @@ class BilibiliLiveRoomWatcher:
         downloader = StreamlinkDownloader,
         started_download = None,
         post_download = None,
+        loop: Optional[EventLoop] = None,
+        resolve_play_url: bool = False,
+        poller: Optional['BiliRoomPoller'] = None,
+        autostart: bool = True,
     ):
         logger.info(f'Monitoring room {room_id}')
         self.room_id = room_id
@@ -40,8 +59,16 @@ class BilibiliLiveRoomWatcher:
         self.title_filter = title_filter and re.compile(title_filter)
         self.heartbeat_interval = heartbeat_interval
         self.heartbeat_received = time.time()
+        self.heartbeat_sent = None
+        self.next_heartbeat = time.time() + heartbeat_interval
         self.error_recover_wait = error_recover_wait
-        self.downloader = downloader
+        self.downloader = get_downloader(downloader)
+        if resolve_play_url and not downloader_accepts(self.downloader, 'play_url'):
+            logger.warning(f'Downloader of room {room_id} does not take a play url, resolving it there instead')
+            resolve_play_url = False
+        self.resolve_play_url = resolve_play_url
+        self.poller = poller or get_bili_room_poller()
+        self.uid = None
         self.started_download = started_download
         self.post_download = post_download
         self.conn: socket.socket = None
@@ -51,114 +78,175 @@ class BilibiliLiveRoomWatcher:
         self.has_finished = False
         self.username = '<loading>'
         self.title = '<loading>'
+        self.loop = loop or get_event_loop(room_id)
+        self.resetting = False
+        self.polling = False
+        self.timer = None
         status_add_watch(self)
+        if autostart:
+            self.start()
+    def start(self):
         self.reset()  # setup connection
         self.poll()
-        self.thread = threading.Thread(target=self.mainloop)
-        self.thread.start()
+        self.timer = self.loop.call_at(self.next_heartbeat, self.on_timer)
     def reset(self):
         try:
             logger.info(f'Reconnecting to room {self.room_id}')
             if self.conn:
-                self.conn.close()
-            self.buffer = b''
-            self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.conn.connect((BILI_SOCK_HOST, BILI_SOCK_PORT))
-            self.conn.setblocking(0)
+                self.loop.remove_reader(self.conn, close=True)
+                self.conn = None
+                metrics.danmaku_reconnects.inc(room=self.room_id)
+            # the timeout covers the dns lookup, the connect and sending the join
+            conn = socket.create_connection((BILI_SOCK_HOST, BILI_SOCK_PORT), timeout=BILI_CONNECT_TIMEOUT)
             # join
-            self.conn.sendall(bili_encode_packet(7, {  # join
+            conn.sendall(bili_encode_packet(7, {  # join
                 'uid': 0,
                 'roomid': self.room_id,
-                'protover': 2,
+                'protover': BILI_PROTOVER,
                 'platform': 'web',
                 'clientver': '1.10.6',
                 'type': 2,
             }))
+            conn.setblocking(0)
+            self.decoder = BiliPacketDecoder()
+            self.conn = conn
+            self.loop.add_reader(conn, self.on_readable, conn)
             self.next_heartbeat = time.time() + self.heartbeat_interval
             self.heartbeat_received = time.time()
+            self.heartbeat_sent = None
+            self.resetting = False
         except:
             logger.exception('Failed to reconnect')
-    def mainloop(self):
-        while True:
-            try:
-                now = time.time()
+            self.resetting = False
+            self.schedule_reset(self.error_recover_wait)
+    def schedule_reset(self, delay: float = 0):
+        # connecting blocks, so it is done on the connect workers instead of the loop,
+        # where it cannot hold up the polls queued on the shared workers
+        if self.resetting:
+            return
+        self.resetting = True
+        if self.conn:
+            self.loop.remove_reader(self.conn)
+        self.loop.call_later(delay, self.loop.run_in_connect_executor, self.reset)
+    def schedule_poll(self):
+        if self.polling:
+            return
+        self.polling = True
+        self.poller.request(self)
+    def run_poll(self):
+        try:
+            self.poll()
+        finally:
+            self.polling = False
+    def on_readable(self, conn):
+        if conn is not self.conn or self.resetting:
+            return
+        try:
+            while True:
+                try:
+                    buf = conn.recv(8192)
+                except socket.error as e:
+                    err = e.args[0]
+                    if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                        break
+                    raise
+                if not buf:  # disconnected
+                    self.schedule_reset()
+                    return
+                self.decoder.feed(buf)
+                self.handle_packets()
+            self.check_downloader()
+        except:
+            logger.exception(f'Caught exception in main loop')
+            self.schedule_reset(self.error_recover_wait)
+    def on_timer(self):
+        try:
+            now = time.time()
+            if not self.resetting:
                 if now - self.heartbeat_received > self.heartbeat_interval * 3:
                     logger.info('No activity on room connection')
-                    self.reset()
-                    continue
-                r, w, x = select.select([self.conn], [], [self.conn], self.next_heartbeat - now)
-                if x:
-                    self.reset()
-                    continue
-                if r:
-                    while True:
-                        try:
-                            buf = self.conn.recv(8192)
-                            if not buf:
-                                break
-                            self.buffer += buf
-                        except socket.error as e:
-                            err = e.args[0]
-                            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                                break
-                            else:
-                                self.reset()
-                                break
-                        self.handle_packets()
-                    if not buf:  # disconnected
-                        self.reset()
-                        continue
-                if self.dl_handle and not self.dl_handle.is_running():
-                    self.need_poll = True
-                if self.need_poll:
-                    self.poll()
-                if not r or time.time() + 0.5 > self.next_heartbeat:
+                    self.schedule_reset()
+                elif now + 0.5 > self.next_heartbeat:
                     self.heartbeat()
-            except:
-                logger.exception(f'Caught exception in main loop')
-                time.sleep(self.error_recover_wait)
-                self.reset()
+            self.check_downloader()
+        except:
+            logger.exception(f'Caught exception in main loop')
+            self.schedule_reset(self.error_recover_wait)
+        finally:
+            self.timer = self.loop.call_at(
+                max(self.next_heartbeat, time.time() + 1),
+                self.on_timer,
+            )
+    def check_downloader(self):
+        if self.dl_handle and not self.dl_handle.is_running():
+            self.need_poll = True
+        if self.need_poll:
+            self.schedule_poll()
     def poll(self):
         try:
-            info = requests.get(BILI_ROOM_INFO_URL.format(room_id=self.room_id)).json()
+            info = get_http_client().get(
+                self.poller.room_info_url.format(room_id=self.room_id),
+                endpoint='bilibili_room_info',
+            ).json()
             room_info = info['data']['room_info']
-            self.username = info['data']['anchor_info']['base_info']['uname']
-            self.title = room_info['title']
-            if room_info['live_status'] == 1:  # living
-                title = room_info['title']
-                if self.live_start_time != room_info['live_start_time']:  # new stream
-                    self.end_recording()
-                    self.live_start_time = room_info['live_start_time']
-                if not self.dl_handle:
-                    if not self.title_filter or self.title_filter.search(title):
-                        # start recording
-                        logger.info(f'Room {self.room_id} started stream: {title}')
-                        dirpath = os.path.join(self.download_path, str(self.live_start_time))
-                        os.makedirs(dirpath, exist_ok=True)
-                        self.dl_handle = self.downloader(
-                            BILI_ROOM_URL.format(room_id=self.room_id),
-                            dirpath=dirpath,
-                        )
-                        if self.started_download:
-                            try:
-                                self.started_download(self.room_id, dirpath)
-                            except:
-                                logger.exception(f'Started download hook error')
-                    else:
-                        logger.debug(f'Filtering out in room {self.room_id}: {title}')
-                elif not self.dl_handle.is_running():  # dl_handle dead
-                    if self.dl_handle.finished():
-                        self.has_finished = True
-                    logger.info(f'Downloader for room {self.room_id} dead, restarting (stream may be ended)')
-                    self.dl_handle = self.downloader(
-                        BILI_ROOM_URL.format(room_id=self.room_id),
-                        dirpath=os.path.join(self.download_path, str(self.live_start_time)),
-                    )
-            else:
-                self.end_recording()
-            self.need_poll = False
+            # the uid lets later polls go through the batched status api
+            self.uid = room_info['uid']
+            self.update_status(
+                info['data']['anchor_info']['base_info']['uname'],
+                room_info['title'],
+                room_info['live_status'],
+                room_info['live_start_time'],
+            )
         except:
             logger.exception(f'Failed to poll {self.room_id}')
+    def update_status(self, username: str, title: str, live_status: int, live_start_time: int):
+        self.username = username
+        self.title = title
+        if live_status == 1:  # living
+            if self.live_start_time != live_start_time:  # new stream
+                self.end_recording()
+                self.live_start_time = live_start_time
+            if not self.dl_handle:
+                if not self.title_filter or self.title_filter.search(title):
+                    # start recording
+                    logger.info(f'Room {self.room_id} started stream: {title}')
+                    dirpath = os.path.join(self.download_path, str(self.live_start_time))
+                    os.makedirs(dirpath, exist_ok=True)
+                    self.dl_handle = self.start_downloader(dirpath)
+                    if self.started_download:
+                        try:
+                            self.started_download(self.room_id, dirpath)
+                        except:
+                            logger.exception(f'Started download hook error')
+                else:
+                    logger.debug(f'Filtering out in room {self.room_id}: {title}')
+            elif not self.dl_handle.is_running():  # dl_handle dead
+                if self.dl_handle.finished():
+                    self.has_finished = True
+                logger.info(f'Downloader for room {self.room_id} dead, restarting (stream may be ended)')
+                self.dl_handle = self.start_downloader(
+                    os.path.join(self.download_path, str(self.live_start_time)),
+                )
+        else:
+            self.end_recording()
+        self.need_poll = False
+    def start_downloader(self, dirpath: str):
+        kwargs = {}
+        if self.resolve_play_url:
+            # the downloader skips stream resolution when it gets the play url
+            kwargs['play_url'] = self.get_play_url()
+        return self.downloader(
+            BILI_ROOM_URL.format(room_id=self.room_id),
+            dirpath=dirpath,
+            **kwargs,
+        )
+    def get_play_url(self) -> Optional[str]:
+        try:
+            info = get_http_client().get(BILI_PLAY_URL.format(room_id=self.room_id), endpoint='bilibili_play_url').json()
+            return info['data']['durl'][0]['url']
+        except:
+            logger.exception(f'Failed to get play url for room {self.room_id}')
+            return None
     def end_recording(self):
         if self.dl_handle:
             dirpath = os.path.join(self.download_path, str(self.live_start_time))
@@ -171,29 +259,21 @@ class BilibiliLiveRoomWatcher:
         self.has_finished = False
     def heartbeat(self):
         self.conn.sendall(bili_encode_packet(2, b''))  # heartbeat
-        self.next_heartbeat = time.time() + self.heartbeat_interval
+        self.heartbeat_sent = time.time()
+        self.next_heartbeat = self.heartbeat_sent + self.heartbeat_interval
     def handle_packets(self):
-        while True:
-            if len(self.buffer) < 16:
-                return
-            packet_len, = struct.unpack('>I', self.buffer[:4])
-            if len(self.buffer) < packet_len:
-                return
+        for proto, op, data in self.decoder.packets():
             self.heartbeat_received = time.time()
-            packet_buf = self.buffer[:packet_len]
-            self.buffer = self.buffer[packet_len:]
-            proto, op, data = bili_decode_packet(packet_buf)
-            logger.debug(f'{proto} {op} {data}')
-            if proto == 2:
-                self.buffer = data + self.buffer
-                continue
+            logger.debug('%s %s %s', proto, op, data)
             if op == 8:  # welcome
                 self.need_poll = True
                 self.heartbeat()
-            elif op == 3:
-                pass  # heartbeat reply?
+            elif op == 3:  # heartbeat reply
+                if self.heartbeat_sent:
+                    metrics.danmaku_heartbeat_seconds.observe(time.time() - self.heartbeat_sent, room=self.room_id)
+                    self.heartbeat_sent = None
             elif op == 5:
-                if data['cmd'] in ['LIVE', 'ROUND', 'CLOSE', 'PREPARING', 'END', 'ROOM_CHANGE']:
+                if bili_packet_cmd(data) in BILI_POLL_CMDS:
                     self.need_poll = True
     def finish_download(self, dl_handle, dirpath, has_finished):
         finished = False
@@ -223,6 +303,94 @@ class BilibiliLiveRoomWatcher:
             + ('[recording]' if self.dl_handle else '')
         ]
 
+class BiliRoomPoller:
+    def __init__(
+        self,
+        *,
+        debounce: float = 2.0,
+        batch_size: int = 50,
+        requests_per_minute: float = 60,
+        loop: Optional[EventLoop] = None,
+        room_info_url: str = BILI_ROOM_INFO_URL,
+        status_url: str = BILI_STATUS_BY_UIDS_URL,
+    ):
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.budget = RateBudget(requests_per_minute)
+        self.loop = loop or get_event_loop()
+        self.room_info_url = room_info_url
+        self.status_url = status_url
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.polled = 0
+        status_add_watch(self)
+    def request(self, watcher: BilibiliLiveRoomWatcher):
+        # rooms asking within the debounce window are polled together
+        with self.lock:
+            self.requests += 1
+            self.pending[watcher.room_id] = watcher
+            if not self.timer:
+                self.timer = self.loop.call_later(self.debounce, self.flush)
+    def flush(self):
+        with self.lock:
+            watchers, self.pending = list(self.pending.values()), {}
+            self.timer = None
+        self.polled += len(watchers)
+        # rooms are only known by uid after their first full room info poll
+        batch = [w for w in watchers if w.uid]
+        for i in range(0, len(batch), self.batch_size):
+            self.dispatch(self.poll_batch, batch[i:i + self.batch_size])
+        for watcher in watchers:
+            if not watcher.uid:
+                self.dispatch(watcher.run_poll)
+    def dispatch(self, func, *args):
+        self.loop.call_later(self.budget.reserve(), self.loop.run_in_executor, func, *args)
+    def poll_batch(self, watchers):
+        try:
+            resp = get_http_client().post(
+                self.status_url,
+                endpoint='bilibili_status_by_uids',
+                json={'uids': [w.uid for w in watchers]},
+            ).json()
+            data = resp['data'] or {}  # an empty list when none of the rooms exist
+        except:
+            # need_poll is still set, so the rooms ask again on their next timer
+            logger.exception('Failed to poll bilibili room status')
+            for watcher in watchers:
+                watcher.polling = False
+            return
+        for watcher in watchers:
+            status = data.get(str(watcher.uid)) if isinstance(data, dict) else None
+            if not status:
+                self.dispatch(watcher.run_poll)
+                continue
+            try:
+                watcher.update_status(status['uname'], status['title'], status['live_status'], status['live_time'])
+            except:
+                logger.exception(f'Failed to poll {watcher.room_id}')
+            finally:
+                watcher.polling = False
+    def status(self):
+        return [f'Bilibili room poller: {self.requests} requests, {self.polled} rooms polled, {len(self.pending)} pending']
+
+_bili_room_poller = None
+_bili_room_poller_lock = threading.Lock()
+
+def configure_bili_room_poller(**kwargs) -> BiliRoomPoller:
+    global _bili_room_poller
+    with _bili_room_poller_lock:
+        _bili_room_poller = BiliRoomPoller(**kwargs)
+        return _bili_room_poller
+
+def get_bili_room_poller() -> BiliRoomPoller:
+    global _bili_room_poller
+    with _bili_room_poller_lock:
+        if not _bili_room_poller:
+            _bili_room_poller = BiliRoomPoller()
+        return _bili_room_poller
+
 def bili_encode_packet(type: int, data):
     if isinstance(data, bytearray):
         data = bytes(data)
@@ -233,13 +401,63 @@ def bili_encode_packet(type: int, data):
     head = struct.pack('>IHHII', len(data) + 16, 16, 1, type, 1)
     return head + data
 
-def bili_decode_packet(buf):
-    packet_len, unk1, protocol, operation, unk2 = struct.unpack('>IHHII', buf[:16])
-    data = buf[16:]
-    if protocol == 0:
-        data = json.loads(data)
-    elif protocol == 1 and len(data) == 4:
-        data = struct.unpack('>I', data)
-    elif protocol == 2:
-        data = zlib.decompress(data)
-    return protocol, operation, data
\ No newline at end of file
+class BiliPacketDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+    def feed(self, data):
+        self.buffer += data
+    def packets(self):
+        # consumed bytes are dropped once per call instead of once per packet
+        view = memoryview(self.buffer)
+        offset = 0
+        try:
+            while True:
+                packet = bili_split_packet(view, offset)
+                if not packet:
+                    return
+                protocol, operation, start, offset = packet
+                with view[start:offset] as body:
+                    yield from bili_decode_packet(protocol, operation, body)
+        finally:
+            view.release()
+            del self.buffer[:offset]
+
+def bili_split_packet(view: memoryview, offset: int):
+    if len(view) - offset < 16:
+        return None
+    packet_len, header_len, protocol, operation, unk = BILI_PACKET_HEADER.unpack_from(view, offset)
+    if header_len < 16 or packet_len < header_len:
+        raise ValueError(f'Malformed packet header: length {packet_len}, header length {header_len}')
+    if len(view) - offset < packet_len:
+        return None
+    return protocol, operation, offset + header_len, offset + packet_len
+
+def bili_decode_packet(protocol: int, operation: int, body: memoryview):
+    if protocol == 2 or protocol == 3:
+        # nested packets are decoded straight out of the decompressed payload
+        with span('bilibili.decompress'):
+            payload = zlib.decompress(body) if protocol == 2 else brotli.decompress(bytes(body))
+        with memoryview(payload) as view:
+            offset = 0
+            while offset < len(view):
+                packet = bili_split_packet(view, offset)
+                if not packet:
+                    raise ValueError('Truncated packet in compressed batch')
+                nested_protocol, nested_operation, start, offset = packet
+                with view[start:offset] as nested_body:
+                    yield from bili_decode_packet(nested_protocol, nested_operation, nested_body)
+        return
+    if protocol == 0 and operation != 5:
+        data = json.loads(bytes(body))
+    elif protocol == 1 and len(body) == 4:
+        data = struct.unpack('>I', body)
+    else:
+        data = bytes(body)  # op 5 messages are parsed lazily, see bili_packet_cmd
+    yield protocol, operation, data
+
+def bili_packet_cmd(data: bytes) -> Optional[str]:
+    # cmd is usually the first key of the message, so avoid parsing the whole body
+    match = BILI_CMD_RE.match(data)
+    if match:
+        return match.group(1).decode('utf8')
+    return json.loads(data).get('cmd')
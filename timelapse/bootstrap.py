@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+import threading
+import concurrent.futures
+from typing import Optional
+
+from .logger import logger
+from .status import status_add_watch
+
+class Bootstrap:
+    def __init__(self, concurrency: int = 8):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix='timelapse-bootstrap',
+        )
+        self.futures = []
+        self.total = 0
+        self.ready = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        status_add_watch(self)
+    def add(self, watcher):
+        # watchers are expected to be constructed with autostart=False
+        with self.lock:
+            self.total += 1
+        self.futures.append(self.executor.submit(self.start_watcher, watcher))
+        return watcher
+    def start_watcher(self, watcher):
+        try:
+            watcher.start()
+            with self.lock:
+                self.ready += 1
+                logger.info(f'Bootstrap progress: {self.ready}/{self.total} ready')
+        except:
+            logger.exception('Failed to start watcher')
+            with self.lock:
+                self.failed += 1
+    def wait(self, timeout: Optional[float] = None):
+        concurrent.futures.wait(self.futures, timeout)
+    def status(self):
+        with self.lock:
+            if self.ready == self.total:
+                return []
+            return [f'Bootstrap: {self.ready}/{self.total} ready, {self.failed} failed']
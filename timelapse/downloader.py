@@ -3,35 +3,27 @@ import os
 import subprocess
 import sys
 import time
-import youtube_dl
-import multiprocessing
-import signal
-import inspect
 import json
 import threading
-import streamlink
-import streamlink.stream
-import magic
+import queue
+import importlib
+import inspect
 import mimetypes
-import you_get.common
+import urllib.parse
 import requests
 from collections import OrderedDict
 from typing import Optional
 
+from . import metrics
+from .httpclient import get_http_client
 from .logger import logger
+from .profiling import span
+from .status import status_add_watch
+from .storage import StorageManager, StorageRecording, get_storage_manager
+from .workerpool import DownloadWorkerPool, get_download_worker_pool
 
-def _ytdl_signal_handler(signum, frame):
-    last_func = None
-    # hacking starts
-    while frame is not None:
-        func = inspect.getframeinfo(frame).function
-        if last_func == 'wait' and func == '_call_downloader':
-            raise KeyboardInterrupt
-        last_func = func
-        frame = frame.f_back
-
-def _ytdl_signaled(url: str, dirpath: str, filename: Optional[str]):
-    signal.signal(signal.SIGUSR1, _ytdl_signal_handler)
+def _ytdl(url: str, dirpath: str, filename: Optional[str]):
+    import youtube_dl
     if not filename:
         filename = '%(id)s'
     ydl_opts = {
@@ -44,15 +36,32 @@ def _ytdl_signaled(url: str, dirpath: str, filename: Optional[str]):
         ydl.download([url])
 
 class YtdlDownloader:
-    def __init__(self, url: str, dirpath: str, filename: Optional[str] = None):
-        logger.info(f'Downloading {url} using youtube-dl')
-        self.proc = multiprocessing.Process(
-            target=_ytdl_signaled,
-            args=(url, dirpath, filename),
-        )
-        self.proc.start()
+    def __init__(
+        self,
+        url: str,
+        dirpath: str,
+        filename: Optional[str] = None,
+        pool: Optional[DownloadWorkerPool] = None,
+        autostart: bool = True,
+    ):
+        self.url = url
+        self.dirpath = dirpath
+        self.filename = filename
+        self.pool = pool
+        self.worker = None
+        self.proc = None
+        if autostart:
+            self.start()
+    @staticmethod
+    def prepare():
+        # called by get_downloader, so the pool is warm before the first go-live
+        get_download_worker_pool()
+    def start(self):
+        logger.info(f'Downloading {self.url} using youtube-dl')
+        self.worker = (self.pool or get_download_worker_pool()).submit(_ytdl, self.url, self.dirpath, self.filename)
+        self.proc = self.worker.proc
     def interrupt(self):
-        os.kill(self.proc.pid, signal.SIGUSR1)
+        self.worker.stop()
     def is_running(self):
         return self.proc.is_alive()
     def wait(self, timeout: Optional[float] = None):
@@ -65,6 +74,7 @@ class YtdlDownloader:
 
 def _youget(url: str, dirpath: str, filename: str):
     try:
+        import you_get.common
         # override bilibili live quality
         from you_get.extractors import Bilibili
         @staticmethod
@@ -88,17 +98,34 @@ def _youget(url: str, dirpath: str, filename: str):
         pass
 
 class YouGetDownloader:
-    def __init__(self, url: str, dirpath: str, filename: Optional[str] = None):
-        logger.info(f'Downloading {url} using youget')
+    def __init__(
+        self,
+        url: str,
+        dirpath: str,
+        filename: Optional[str] = None,
+        pool: Optional[DownloadWorkerPool] = None,
+        autostart: bool = True,
+    ):
         if not filename:
             filename = str(int(time.time()))
-        self.proc = multiprocessing.Process(
-            target=_youget,
-            args=(url, dirpath, filename),
-        )
-        self.proc.start()
+        self.url = url
+        self.dirpath = dirpath
+        self.filename = filename
+        self.pool = pool
+        self.worker = None
+        self.proc = None
+        if autostart:
+            self.start()
+    @staticmethod
+    def prepare():
+        # called by get_downloader, so the pool is warm before the first go-live
+        get_download_worker_pool()
+    def start(self):
+        logger.info(f'Downloading {self.url} using youget')
+        self.worker = (self.pool or get_download_worker_pool()).submit(_youget, self.url, self.dirpath, self.filename)
+        self.proc = self.worker.proc
     def interrupt(self):
-        os.kill(self.proc.pid, signal.SIGINT)
+        self.worker.stop()
     def is_running(self):
         return self.proc.is_alive()
     def wait(self, timeout: Optional[float] = None):
@@ -109,15 +136,104 @@ class YouGetDownloader:
         return self.proc.exitcode == 0
 
 
-_streamlink = streamlink.Streamlink({
-    'hds-timeout': 20.0,
-    'hls-timeout': 20.0,
-    'http-timeout': 20.0,
-    'http-stream-timeout': 20.0,
-    'stream-timeout': 20.0,
-    'rtmp-timeout': 20.0,
-    'http-ssl-verify': False,
-})
+_streamlink = None
+_streamlink_lock = threading.Lock()
+
+def _get_streamlink():
+    global _streamlink
+    with _streamlink_lock:
+        if not _streamlink:
+            import streamlink
+            _streamlink = streamlink.Streamlink({
+                'hds-timeout': 20.0,
+                'hls-timeout': 20.0,
+                'http-timeout': 20.0,
+                'http-stream-timeout': 20.0,
+                'stream-timeout': 20.0,
+                'rtmp-timeout': 20.0,
+                'http-ssl-verify': False,
+            })
+        return _streamlink
+
+# how long resolved streams of a page stay usable, by host
+STREAM_CACHE_TTLS = {
+    'youtube.com': 3600,
+    'bilibili.com': 600,
+}
+STREAM_GONE_STATUS = (403, 404)
+
+def _http_status(e) -> Optional[int]:
+    # streamlink wraps the requests exception in StreamError.err
+    response = getattr(getattr(e, 'err', e), 'response', None)
+    return response.status_code if response is not None else None
+
+def _direct_stream(url: str):
+    import streamlink.stream
+    if urllib.parse.urlsplit(url).path.endswith('.m3u8'):
+        return streamlink.stream.HLSStream(_get_streamlink(), url)
+    return streamlink.stream.HTTPStream(_get_streamlink(), url)
+
+class StreamCache:
+    def __init__(self, ttls = STREAM_CACHE_TTLS, default_ttl: int = 300):
+        self.ttls = dict(ttls)
+        self.default_ttl = default_ttl
+        self.entries = {}  # page url -> (expire time, streams)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        status_add_watch(self)
+    def ttl(self, url: str) -> int:
+        host = urllib.parse.urlsplit(url).hostname or ''
+        for suffix, ttl in self.ttls.items():
+            if host == suffix or host.endswith('.' + suffix):
+                return ttl
+        return self.default_ttl
+    def streams(self, url: str):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        streams = _get_streamlink().streams(url)
+        if streams:
+            with self.lock:
+                self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+                self.entries[url] = (now + self.ttl(url), streams)
+        return streams
+    def invalidate(self, url: str):
+        with self.lock:
+            self.entries.pop(url, None)
+    def status(self):
+        with self.lock:
+            return [f'Stream cache: {len(self.entries)} pages, {self.hits} hits, {self.misses} misses']
+
+_stream_cache = None
+_stream_cache_lock = threading.Lock()
+
+def configure_stream_cache(**kwargs) -> StreamCache:
+    global _stream_cache
+    with _stream_cache_lock:
+        _stream_cache = StreamCache(**kwargs)
+        return _stream_cache
+
+def get_stream_cache() -> StreamCache:
+    global _stream_cache
+    with _stream_cache_lock:
+        if not _stream_cache:
+            _stream_cache = StreamCache()
+        return _stream_cache
+
+def prewarm_connections(urls):
+    # resolve DNS and open TLS connections to the hosts a download is about to use
+    session = _get_streamlink()
+    for url in urls:
+        get_http_client().prewarm(url)
+        try:
+            session.http.head(url, timeout=10)
+        except Exception as e:
+            logger.debug(f'Failed to prewarm {url}: {repr(e)}')
 
 class StreamlinkDownloader:
     def __init__(
@@ -125,15 +241,24 @@ class StreamlinkDownloader:
         url: str,
         dirpath: str,
         filename: Optional[str] = None,
-        bufsize: int = 8192,
+        bufsize: int = 1 << 20,
         stream_timeout: int = 300,
         resolv_retry_interval: int = 5,
         resolv_retry_count: int = 4,
+        queue_depth: int = 16,
+        flush_interval: float = 5.0,
+        fsync: bool = False,
+        priority: int = 0,
+        storage: Optional[StorageManager] = None,
+        play_url: Optional[str] = None,
+        start_at: Optional[float] = None,
+        autostart: bool = True,
     ):
-        logger.info(f'Downloading {url} using streamlink')
         if not filename:
             filename = str(int(time.time()))
         self.url = url
+        self.play_url = play_url
+        self.start_at = start_at
         self.dirpath = dirpath
         self.filename = filename
         self.extname = None
@@ -141,9 +266,24 @@ class StreamlinkDownloader:
         self.stream_timeout = stream_timeout
         self.resolv_retry_interval = resolv_retry_interval
         self.resolv_retry_count = resolv_retry_count
+        self.queue_depth = queue_depth
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.priority = priority
+        self.storage = storage or get_storage_manager()
+        self.written_bytes = 0
+        self.max_queued = 0
+        self.reader_wait = 0.0  # time spent waiting for the disk
+        self.writer_wait = 0.0  # time spent waiting for the network
+        self._queue = None
         self._interrupted = False
         self._finished = False
+        self._write_error = None
         self.thread = threading.Thread(target=self._download)
+        if autostart:
+            self.start()
+    def start(self):
+        logger.info(f'Downloading {self.url} using streamlink')
         self.thread.start()
     def interrupt(self):
         self._interrupted = True
@@ -155,38 +295,79 @@ class StreamlinkDownloader:
         self._interrupted = True
     def finished(self):
         return self._finished
+    def stats(self):
+        return {
+            'written_bytes': self.written_bytes,
+            'queued': self._queue.qsize() if self._queue else 0,
+            'max_queued': self.max_queued,
+            'reader_wait': self.reader_wait,
+            'writer_wait': self.writer_wait,
+        }
+    def _resolve(self):
+        streams = None
+        resolv_exception = None
+        for i in range(1, self.resolv_retry_count + 1):
+            if self._interrupted:
+                self._finished = True
+                return None
+            try:
+                streams = get_stream_cache().streams(self.url)
+            except Exception as e:
+                resolv_exception = e
+            if streams or i == self.resolv_retry_count:
+                break
+            logger.debug(f'Failed to resolve {self.url}, retry #{i}')
+            time.sleep(self.resolv_retry_interval)
+        if self._interrupted:
+            self._finished = True
+            return None
+        if not streams:
+            if type(streams) is not dict:
+                logger.error(f'Failed to resolve {self.url}: {repr(resolv_exception)}')
+            return None
+        return streams['best']
+    def _open(self):
+        if self.play_url:
+            # handed over by the watcher, so no resolution is needed
+            stream = _direct_stream(self.play_url)
+            try:
+                return stream, stream.open()
+            except Exception as e:
+                logger.info(f'Play url of {self.url} failed, resolving instead: {repr(e)}')
+        for attempt in range(2):
+            stream = self._resolve()
+            if not stream:
+                return None, None
+            logger.debug(f'Streamlink stream: {stream}')
+            try:
+                return stream, stream.open()
+            except Exception as e:
+                if attempt or _http_status(e) not in STREAM_GONE_STATUS:
+                    raise
+                # the cached streams expired early
+                get_stream_cache().invalidate(self.url)
     def _download(self):
+        import magic
+        import streamlink.stream
+        storage = None
         try:
             filename = self.filename
             infile = None
-            streams = None
-            resolv_exception = None
-            for i in range(1, self.resolv_retry_count + 1):
-                if self._interrupted:
-                    self._finished = True
-                    return
-                try:
-                    streams = _streamlink.streams(self.url)
-                except Exception as e:
-                    resolv_exception = e
-                if streams or i == self.resolv_retry_count:
-                    break
-                logger.debug(f'Failed to resolve {self.url}, retry #{i}')
-                time.sleep(self.resolv_retry_interval)
-            if self._interrupted:
-                self._finished = True
+            storage = self.storage.admit(self.dirpath, self.priority)
+            if not storage:
                 return
-            if not streams:
-                if type(streams) is not dict:
-                    logger.error(f'Failed to resolve {self.url}: {repr(resolv_exception)}')
+            stream, infile = self._open()
+            if not stream:
                 return
-            stream = streams['best']
-            logger.debug(f'Streamlink stream: {stream}')
-            written_bytes = 0
-            infile = stream.open()
-            buffer = infile.read(self.bufsize)
-            assert buffer
-            mime = magic.from_buffer(buffer, mime=True)
+            free_buffers = queue.Queue()
+            for i in range(self.queue_depth):
+                free_buffers.put(bytearray(self.bufsize))
+            self._queue = queue.Queue()
+            buffer = free_buffers.get()
+            size = _read_into(infile, buffer)
+            assert size
+            with span('downloader.sniff'):
+                mime = magic.from_buffer(bytes(buffer[:min(size, 8192)]), mime=True)
             if mime == 'video/MP2T':
                 self.extname = '.ts'
             else:
@@ -196,15 +377,23 @@ class StreamlinkDownloader:
                 filename += self.extname
             outfilename = os.path.join(self.dirpath, filename)
             logger.info(f'Download destination: {outfilename}')
+            writer = threading.Thread(target=self._write, args=(outfilename, free_buffers, storage))
+            writer.start()
             last_active = time.time()
-            with open(outfilename, 'wb') as outfile:
+            try:
                 while not self._interrupted:
-                    if buffer:
-                        outfile.write(buffer)
-                        written_bytes += len(buffer)
+                    if size and self.start_at and time.time() < self.start_at:
+                        size = 0  # connected early, data before start_at is dropped
+                    if size:
+                        self._queue.put((buffer, size))
+                        self.max_queued = max(self.max_queued, self._queue.qsize())
+                        wait_start = time.time()
+                        buffer = free_buffers.get()
+                        self.reader_wait += time.time() - wait_start
                     try:
-                        buffer = infile.read(self.bufsize)
-                        if not buffer:
+                        with span('downloader.read'):
+                            size = _read_into(infile, buffer)
+                        if not size:
                             if type(stream) is streamlink.stream.HTTPStream:
                                 logger.debug(f'Streamlink reconnecting to stream {self.url}')
                                 infile.close()
@@ -219,7 +408,7 @@ class StreamlinkDownloader:
                         if hasattr(e, 'args') and e.args == ('Read timeout',):
                             if time.time() - last_active < self.stream_timeout:
                                 logger.debug('streamlink stream read retry')
-                                buffer = None
+                                size = 0
                                 continue
                         raise
                     except streamlink.StreamError as e:
@@ -231,15 +420,117 @@ class StreamlinkDownloader:
                                 and time.time() - last_active < self.stream_timeout
                             ):
                                 logger.debug('streamlink stream read retry')
-                                buffer = None
+                                size = 0
                                 continue
                             elif type(e.err) is requests.HTTPError:
+                                if _http_status(e) in STREAM_GONE_STATUS:
+                                    get_stream_cache().invalidate(self.url)
                                 break
                         raise
-            logger.info(f'Streamlink finished {self.url}, file stored to {outfilename}')
+            finally:
+                self._queue.put(None)
+                writer.join()
+            if self._write_error:
+                raise self._write_error
+            logger.info(
+                f'Streamlink finished {self.url}, file stored to {outfilename} '
+                f'({self.written_bytes} bytes, max queued {self.max_queued}, '
+                f'disk wait {self.reader_wait:.1f}s, network wait {self.writer_wait:.1f}s)'
+            )
             self._finished = True
         except Exception as e:
             logger.error(f'Failed to download {self.url}: {e}')
         finally:
             if infile:
                 infile.close()
+            if storage:
+                storage.release()
+    def _write(self, outfilename: str, free_buffers: queue.Queue, storage: StorageRecording):
+        last_write = None
+        try:
+            with open(outfilename, 'wb', buffering=0) as outfile:
+                last_flush = time.time()
+                while True:
+                    wait_start = time.time()
+                    item = self._queue.get()
+                    self.writer_wait += time.time() - wait_start
+                    if item is None:
+                        break
+                    buffer, size = item
+                    with memoryview(buffer)[:size] as view:
+                        while view:
+                            written = outfile.write(view)
+                            view = view[written:]
+                    self.written_bytes += size
+                    storage.written(outfile, size)
+                    free_buffers.put(buffer)
+                    now = time.time()
+                    metrics.download_written(outfilename, size, now, last_write)
+                    metrics.download_queued.set(self._queue.qsize(), download=outfilename)
+                    last_write = now
+                    if self.fsync and time.time() - last_flush >= self.flush_interval:
+                        os.fsync(outfile.fileno())
+                        last_flush = time.time()
+                if self.fsync:
+                    os.fsync(outfile.fileno())
+        except Exception as e:
+            self._write_error = e
+            self._interrupted = True
+            # keep the reader from blocking on a full queue
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                free_buffers.put(item[0])
+        finally:
+            metrics.download_finished(outfilename)
+
+def _read_into(infile, buffer: bytearray) -> int:
+    # the readers streamlink hands out (StreamIO, StreamIOIterWrapper and the
+    # segmented readers) are io.IOBase without readinto, they end up in the
+    # read() and copy below. Only readers that do have readinto fill the buffer directly
+    if hasattr(infile, 'readinto'):
+        return infile.readinto(buffer) or 0
+    data = infile.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+DOWNLOADERS = {
+    'streamlink': 'timelapse.downloader:StreamlinkDownloader',
+    'youtube-dl': 'timelapse.downloader:YtdlDownloader',
+    'you-get': 'timelapse.downloader:YouGetDownloader',
+    'hls': 'timelapse.hls:HlsDownloader',
+}
+
+def register_downloader(name: str, downloader):
+    # downloader is a factory or a 'module:attribute' path imported on first use,
+    # called as downloader(url, dirpath, filename). The optional keyword arguments
+    # play_url, start_at and autostart are only passed if the factory takes them,
+    # see downloader_accepts
+    DOWNLOADERS[name] = downloader
+
+def downloader_accepts(downloader, option: str) -> bool:
+    try:
+        params = inspect.signature(downloader).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.name == option or p.kind is inspect.Parameter.VAR_KEYWORD for p in params)
+
+def get_downloader(downloader):
+    if not isinstance(downloader, str):
+        factory = downloader
+    elif downloader not in DOWNLOADERS:
+        raise ValueError(f'Unknown downloader {downloader}')
+    else:
+        factory = DOWNLOADERS[downloader]
+        if isinstance(factory, str):
+            module, _, attr = factory.partition(':')
+            factory = getattr(importlib.import_module(module), attr)
+            DOWNLOADERS[downloader] = factory
+    # watchers resolve their downloader on construction, which is when
+    # backends get to start up whatever they need
+    prepare = getattr(factory, 'prepare', None)
+    if prepare:
+        prepare()
+    return factory
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+from .logger import logger
+from .status import status_add_watch
+
+class TimerHandle:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+    def __init__(self, when: float, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop:
+    def __init__(self, name: str = 'timelapse-loop', workers: int = 4, connect_workers: int = 2):
+        self.name = name
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-worker')
+        # reconnects can block until their timeout, they get workers of their own
+        self.connect_executor = ThreadPoolExecutor(max_workers=connect_workers, thread_name_prefix=f'{name}-connect')
+        # socketpair used to interrupt select() from other threads
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(0)
+        self.wakeup_w.setblocking(0)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, (self._drain_wakeup, ()))
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.start()
+        metrics.queue_depth.add(lambda: len(self.timers), queue=f'{name}-timers')
+        metrics.queue_depth.add(self.executor._work_queue.qsize, queue=f'{name}-executor')
+        metrics.queue_depth.add(self.connect_executor._work_queue.qsize, queue=f'{name}-connect')
+        status_add_watch(self)
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+    def call_soon_threadsafe(self, callback, *args):
+        self.pending.append((callback, args))
+        self._wakeup()
+    def call_at(self, when: float, callback, *args) -> TimerHandle:
+        timer = TimerHandle(when, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers, (when, next(self.timer_seq), timer))
+            earliest = self.timers[0][2] is timer
+        if earliest and not self.in_loop():
+            self._wakeup()
+        return timer
+    def call_later(self, delay: float, callback, *args) -> TimerHandle:
+        return self.call_at(time.time() + delay, callback, *args)
+    def run_in_executor(self, func, *args):
+        return self.executor.submit(self._run_logged, func, args)
+    def run_in_connect_executor(self, func, *args):
+        return self.connect_executor.submit(self._run_logged, func, args)
+    def add_reader(self, sock, callback, *args):
+        if not self.in_loop():
+            self.call_soon_threadsafe(self.add_reader, sock, callback, *args)
+            return
+        self.selector.register(sock, selectors.EVENT_READ, (callback, args))
+    def remove_reader(self, sock, close: bool = False):
+        if not self.in_loop():
+            self.call_soon_threadsafe(self.remove_reader, sock, close)
+            return
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        if close:
+            sock.close()
+    def run(self):
+        while self.running:
+            try:
+                self._run_once()
+            except:
+                logger.exception(f'Caught exception in event loop {self.name}')
+    def _run_once(self):
+        with self.lock:
+            while self.timers and self.timers[0][2].cancelled:
+                heapq.heappop(self.timers)
+            timeout = self.timers[0][0] - time.time() if self.timers else None
+        if self.pending:
+            timeout = 0
+        elif timeout is not None and timeout < 0:
+            timeout = 0
+        for key, mask in self.selector.select(timeout):
+            callback, args = key.data
+            self._run_logged(callback, args)
+        while self.pending:
+            callback, args = self.pending.popleft()
+            self._run_logged(callback, args)
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+        for timer in due:
+            if not timer.cancelled:
+                self._run_logged(timer.callback, timer.args)
+    def _run_logged(self, callback, args):
+        try:
+            return callback(*args)
+        except:
+            logger.exception(f'Caught exception in callback {callback}')
+    def stop(self):
+        # pending timers are dropped, running executor jobs are left to finish
+        self.running = False
+        self._wakeup()
+        self.executor.shutdown(wait=False)
+        self.connect_executor.shutdown(wait=False)
+    def _wakeup(self):
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass  # already pending
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+    def status(self):
+        return [f'Event loop {self.name}: {len(self.selector.get_map()) - 1} sockets, {len(self.timers)} timers']
+
+
+_loop_pool_size = 1
+_loop_workers = 4
+_loops = []
+_loops_lock = threading.Lock()
+
+def set_event_loop_pool_size(size: int, workers: int = 4):
+    global _loop_pool_size, _loop_workers
+    with _loops_lock:
+        assert not _loops, 'event loops already started'
+        _loop_pool_size = size
+        _loop_workers = workers
+
+def get_event_loop(key = None) -> EventLoop:
+    with _loops_lock:
+        if not _loops:
+            for i in range(_loop_pool_size):
+                _loops.append(EventLoop(f'timelapse-loop-{i}', _loop_workers))
+        return _loops[hash(key) % len(_loops) if key is not None else 0]
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+import os
+import re
+import threading
+import time
+import urllib.parse
+import concurrent.futures
+from collections import namedtuple
+from typing import Optional
+
+from . import metrics
+from .logger import logger
+from .downloader import STREAM_GONE_STATUS, _http_status, get_stream_cache
+from .httpclient import get_http_client
+from .storage import StorageManager, get_storage_manager
+
+HlsSegment = namedtuple('HlsSegment', ['sequence', 'url', 'duration'])
+HlsPlaylist = namedtuple('HlsPlaylist', ['variants', 'segments', 'target_duration', 'map_url', 'encrypted', 'endlist'])
+
+_HLS_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+HLS_CONTENT_TYPES = ('application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'audio/x-mpegurl')
+
+def hls_is_playlist_url(url: str) -> bool:
+    return urllib.parse.urlsplit(url).path.endswith('.m3u8')
+
+def hls_parse_attrs(value: str):
+    return {k: v.strip('"') for k, v in _HLS_ATTR_RE.findall(value)}
+
+def hls_parse_playlist(text: str, base_url: str) -> HlsPlaylist:
+    variants = []
+    segments = []
+    target_duration = 5.0
+    sequence = 0
+    map_url = None
+    encrypted = False
+    endlist = False
+    duration = None
+    bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            tag, _, value = line.partition(':')
+            if tag == '#EXT-X-TARGETDURATION':
+                target_duration = float(value)
+            elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                sequence = int(value)
+            elif tag == '#EXTINF':
+                duration = float(value.split(',')[0])
+            elif tag == '#EXT-X-STREAM-INF':
+                bandwidth = int(hls_parse_attrs(value).get('BANDWIDTH', 0))
+            elif tag == '#EXT-X-MAP':
+                map_url = urllib.parse.urljoin(base_url, hls_parse_attrs(value)['URI'])
+            elif tag == '#EXT-X-KEY':
+                encrypted = encrypted or hls_parse_attrs(value).get('METHOD', 'NONE') != 'NONE'
+            elif tag == '#EXT-X-ENDLIST':
+                endlist = True
+            continue
+        url = urllib.parse.urljoin(base_url, line)
+        if bandwidth is not None:
+            variants.append((bandwidth, url))
+            bandwidth = None
+        elif duration is not None:
+            segments.append(HlsSegment(sequence, url, duration))
+            sequence += 1
+            duration = None
+    return HlsPlaylist(variants, segments, target_duration, map_url, encrypted, endlist)
+
+
+class HlsDownloader:
+    def __init__(
+        self,
+        url: str,
+        dirpath: str,
+        filename: Optional[str] = None,
+        *,
+        parallel: int = 4,
+        live_edge: int = 3,
+        stream_timeout: int = 300,
+        segment_retry_count: int = 3,
+        resolv_retry_interval: int = 5,
+        resolv_retry_count: int = 4,
+        priority: int = 0,
+        storage: Optional[StorageManager] = None,
+        play_url: Optional[str] = None,
+        start_at: Optional[float] = None,
+        autostart: bool = True,
+    ):
+        if not filename:
+            filename = str(int(time.time()))
+        self.url = url
+        self.play_url = play_url
+        self.start_at = start_at
+        self.dirpath = dirpath
+        self.filename = filename
+        self.parallel = parallel
+        self.live_edge = live_edge
+        self.stream_timeout = stream_timeout
+        self.segment_retry_count = segment_retry_count
+        self.resolv_retry_interval = resolv_retry_interval
+        self.resolv_retry_count = resolv_retry_count
+        self.priority = priority
+        self.storage = storage or get_storage_manager()
+        self.playlist_url = None
+        self.renew_count = 0
+        self._renewed_url = None
+        self.written_bytes = 0
+        self.last_write = None
+        self.written_segments = 0
+        self.skipped_segments = 0
+        self._interrupted = False
+        self._finished = False
+        self.thread = threading.Thread(target=self._download)
+        if autostart:
+            self.start()
+    def start(self):
+        logger.info(f'Downloading {self.url} using native HLS')
+        self.thread.start()
+    def interrupt(self):
+        self._interrupted = True
+    def is_running(self):
+        return self.thread.is_alive()
+    def wait(self, timeout: Optional[float] = None):
+        self.thread.join(timeout)
+    def kill(self):
+        self._interrupted = True
+    def finished(self):
+        return self._finished
+    def _resolve(self) -> Optional[str]:
+        if self.play_url:
+            # handed over by the watcher, only used once so that renewals resolve
+            play_url, self.play_url = self.play_url, None
+            return play_url
+        if hls_is_playlist_url(self.url):
+            return self.url
+        from streamlink.stream.hls import HLSStream
+        for i in range(1, self.resolv_retry_count + 1):
+            if self._interrupted:
+                return None
+            try:
+                streams = get_stream_cache().streams(self.url)
+                if streams:
+                    if not isinstance(streams['best'], HLSStream):
+                        # e.g. the FLV stream of bilibili, it never ends and would be read into memory
+                        logger.error(f'{self.url} is not an HLS stream ({type(streams["best"]).__name__})')
+                        return None
+                    return streams['best'].url
+            except Exception as e:
+                logger.debug(f'Failed to resolve {self.url}: {repr(e)}')
+            if i < self.resolv_retry_count:
+                time.sleep(self.resolv_retry_interval)
+        return None
+    def _load_playlist(self) -> HlsPlaylist:
+        while True:
+            # the body is only read once the response is known to be a playlist
+            with get_http_client().get(self.playlist_url, stream=True) as resp:
+                resp.raise_for_status()
+                content_type = resp.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type not in HLS_CONTENT_TYPES and not hls_is_playlist_url(resp.url):
+                    raise ValueError(f'Not an HLS playlist: {self.playlist_url} ({content_type or "no content type"})')
+                text = resp.text
+            if not text.lstrip().startswith('#EXTM3U'):
+                raise ValueError(f'Not an HLS playlist: {self.playlist_url}')
+            playlist = hls_parse_playlist(text, resp.url)
+            if not playlist.variants:
+                return playlist
+            self.playlist_url = max(playlist.variants)[1]
+            logger.debug(f'Selected HLS variant {self.playlist_url}')
+    def _fetch_segment(self, url: str) -> Optional[bytes]:
+        for i in range(1, self.segment_retry_count + 1):
+            if self._interrupted:
+                return None
+            try:
+                resp = get_http_client().get(url)
+                resp.raise_for_status()
+                return resp.content
+            except Exception as e:
+                if i == self.segment_retry_count:
+                    logger.warning(f'Failed to fetch segment {url}: {repr(e)}')
+        return None
+    def renew(self):
+        # resolve a fresh playlist url in the background, the download loop
+        # switches to it on its next reload and keeps the media sequence
+        if self.url == self.playlist_url:
+            return
+        threading.Thread(target=self._renew).start()
+    def _renew(self):
+        get_stream_cache().invalidate(self.url)
+        playlist_url = self._resolve()
+        if playlist_url:
+            self._renewed_url = playlist_url
+        else:
+            logger.error(f'Failed to renew HLS playlist for {self.url}')
+    def _write_segment(self, outfile, data: Optional[bytes], init: bool = False):
+        if data and not init and self.start_at and time.time() < self.start_at:
+            return  # connected early, segments before start_at are dropped
+        if data:
+            outfile.write(data)
+            self.written_bytes += len(data)
+            self.written_segments += 1
+            self._storage.written(outfile, len(data))
+            now = time.time()
+            metrics.download_written(outfile.name, len(data), now, self.last_write)
+            self.last_write = now
+        else:
+            self.skipped_segments += 1
+    def _download(self):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel)
+        self._storage = None
+        outfilename = None
+        try:
+            self._storage = self.storage.admit(self.dirpath, self.priority)
+            if not self._storage:
+                return
+            self.playlist_url = self._resolve()
+            if self._interrupted:
+                self._finished = True
+                return
+            if not self.playlist_url:
+                logger.error(f'Failed to resolve HLS playlist for {self.url}')
+                return
+            try:
+                playlist = self._load_playlist()
+            except Exception as e:
+                if _http_status(e) not in STREAM_GONE_STATUS:
+                    raise
+                # the cached or handed over playlist expired, resolve once more
+                get_stream_cache().invalidate(self.url)
+                self.playlist_url = self._resolve()
+                if not self.playlist_url:
+                    raise
+                playlist = self._load_playlist()
+            if playlist.encrypted:
+                logger.error(f'Encrypted HLS stream is not supported: {self.url}')
+                return
+            extname = '.mp4' if playlist.map_url else '.ts'
+            outfilename = os.path.join(self.dirpath, self.filename + extname)
+            logger.info(f'Download destination: {outfilename}')
+            # segments are fetched concurrently but written strictly in sequence order
+            pending = {}
+            max_pending = self.parallel * 2
+            last_queued = None
+            if playlist.segments:
+                first = playlist.segments[0 if playlist.endlist else -min(self.live_edge, len(playlist.segments))]
+                last_queued = first.sequence - 1
+            next_write = last_queued + 1 if last_queued is not None else None
+            next_reload = time.time() + playlist.target_duration / 2
+            last_active = time.time()
+            with open(outfilename, 'wb') as outfile:
+                if playlist.map_url:
+                    self._write_segment(outfile, self._fetch_segment(playlist.map_url), init=True)
+                while not self._interrupted:
+                    for segment in playlist.segments:
+                        if len(pending) >= max_pending:
+                            break
+                        if last_queued is None:
+                            last_queued = next_write = segment.sequence - 1
+                            next_write += 1
+                        if segment.sequence <= last_queued:
+                            continue
+                        pending[segment.sequence] = executor.submit(self._fetch_segment, segment.url)
+                        last_queued = segment.sequence
+                        last_active = time.time()
+                    if pending and next_write not in pending:
+                        skipped = min(pending) - next_write
+                        logger.warning(f'Skipped {skipped} HLS segments of {self.url}')
+                        self.skipped_segments += skipped
+                        next_write = min(pending)
+                    while next_write in pending and pending[next_write].done():
+                        self._write_segment(outfile, pending.pop(next_write).result())
+                        next_write += 1
+                    if playlist.endlist:
+                        if not pending and (not playlist.segments or last_queued >= playlist.segments[-1].sequence):
+                            break
+                    elif time.time() >= next_reload:
+                        if time.time() - last_active > self.stream_timeout:
+                            logger.info(f'No new HLS segments for {self.url}, assuming stream ended')
+                            break
+                        renewed = self._renewed_url is not None
+                        if renewed:
+                            self.playlist_url, self._renewed_url = self._renewed_url, None
+                            self.renew_count += 1
+                        try:
+                            playlist = self._load_playlist()
+                        except Exception as e:
+                            logger.debug(f'Failed to reload playlist {self.playlist_url}: {repr(e)}')
+                            if _http_status(e) in STREAM_GONE_STATUS:
+                                get_stream_cache().invalidate(self.url)
+                            renewed = False
+                        if renewed:
+                            logger.info(f'Handed over {self.url} to a renewed playlist after segment {next_write - 1}')
+                            if playlist.segments and playlist.segments[-1].sequence < last_queued - len(playlist.segments):
+                                # sequence numbering restarted, finish the old numbering first
+                                logger.warning(f'HLS media sequence restarted for {self.url}')
+                                for sequence in sorted(pending):
+                                    self._write_segment(outfile, pending.pop(sequence).result())
+                                first = playlist.segments[-min(self.live_edge, len(playlist.segments))]
+                                last_queued = first.sequence - 1
+                                next_write = first.sequence
+                        next_reload = time.time() + max(playlist.target_duration / 2, 1)
+                        continue
+                    head = pending.get(next_write)
+                    timeout = max(next_reload - time.time(), 0.1)
+                    if head:
+                        concurrent.futures.wait([head], timeout)
+                    elif not playlist.endlist:
+                        time.sleep(timeout)
+            logger.info(
+                f'HLS finished {self.url}, file stored to {outfilename} '
+                f'({self.written_segments} segments, {self.skipped_segments} skipped)'
+            )
+            self._finished = True
+        except Exception as e:
+            logger.error(f'Failed to download {self.url}: {e}')
+        finally:
+            executor.shutdown(wait=False)
+            if outfilename:
+                metrics.download_finished(outfilename)
+            if self._storage:
+                self._storage.release()
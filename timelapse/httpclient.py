@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+import threading
+import time
+import urllib.parse
+import requests
+import requests.adapters
+from typing import Optional
+
+from . import metrics
+from .logger import logger
+from .status import status_add_watch
+
+class HttpClient:
+    def __init__(
+        self,
+        *,
+        pool_connections: int = 16,
+        pool_maxsize: int = 16,
+        timeout: Optional[float] = 20.0,
+        max_retries: int = 0,
+    ):
+        self.timeout = timeout
+        # the adapter keeps one keep-alive pool of pool_maxsize connections per host
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries,
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.request_count = {}
+        self.error_count = {}
+        status_add_watch(self)
+    def request(self, method: str, url: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        host = urllib.parse.urlsplit(url).netloc
+        endpoint = endpoint or host
+        with self.lock:
+            self.request_count[host] = self.request_count.get(host, 0) + 1
+        start = time.time()
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except:
+            with self.lock:
+                self.error_count[host] = self.error_count.get(host, 0) + 1
+            metrics.http_errors.inc(endpoint=endpoint)
+            raise
+        finally:
+            metrics.http_request_seconds.observe(time.time() - start, endpoint=endpoint)
+        if resp.status_code >= 400:
+            metrics.http_errors.inc(endpoint=endpoint)
+        return resp
+    def get(self, url: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+        return self.request('GET', url, endpoint, **kwargs)
+    def post(self, url: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+        return self.request('POST', url, endpoint, **kwargs)
+    def prewarm(self, url: str):
+        # open a pooled keep-alive connection ahead of time, the response itself does not matter
+        try:
+            self.session.head(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.debug(f'Failed to prewarm {url}: {repr(e)}')
+    def status(self):
+        with self.lock:
+            return [
+                f'HTTP {host}: {count} requests, {self.error_count.get(host, 0)} errors'
+                for host, count in sorted(self.request_count.items())
+            ]
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def configure_http_client(**kwargs) -> HttpClient:
+    global _http_client
+    with _http_client_lock:
+        _http_client = HttpClient(**kwargs)
+        return _http_client
+
+def get_http_client() -> HttpClient:
+    global _http_client
+    with _http_client_lock:
+        if not _http_client:
+            _http_client = HttpClient()
+        return _http_client
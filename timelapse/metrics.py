@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+import http.server
+import threading
+from typing import Tuple
+
+from .logger import logger
+
+def _format_labels(labelnames, labelvalues) -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(labelnames, labelvalues)
+    ]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    type = 'untyped'
+    def __init__(self, name: str, help: str, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Summary(Metric):
+    type = 'summary'
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            total, count = self.values.get(key, (0, 0))
+            self.values[key] = (total + value, count + 1)
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [
+            sample
+            for key, (total, count) in items
+            for sample in ((self.name + '_sum', key, total), (self.name + '_count', key, count))
+        ]
+
+class CallbackGauge(Metric):
+    # for values that are cheap to read at scrape time, such as queue sizes
+    type = 'gauge'
+    def add(self, callback, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = callback
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        samples = []
+        for key, callback in items:
+            try:
+                samples.append((self.name, key, callback()))
+            except:
+                logger.exception(f'Failed to collect metric {self.name}')
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+    def register(self, metric: Metric):
+        with self.lock:
+            self.metrics.append(metric)
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics)
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+registry = MetricsRegistry()
+
+download_bytes = Counter('timelapse_download_bytes_total', 'Bytes written by active downloads', ['download'])
+download_last_write = Gauge('timelapse_download_last_write_timestamp_seconds', 'Time of the last write of active downloads', ['download'])
+download_stall_seconds = Summary('timelapse_download_stall_seconds', 'Gaps of more than 5 seconds between writes', ['download'])
+download_queued = Gauge('timelapse_download_queued_buffers', 'Buffers waiting for the writer of active downloads', ['download'])
+http_request_seconds = Summary('timelapse_http_request_seconds', 'Latency of API requests', ['endpoint'])
+http_errors = Counter('timelapse_http_errors_total', 'Failed API requests', ['endpoint'])
+danmaku_reconnects = Counter('timelapse_danmaku_reconnects_total', 'Bilibili danmaku reconnects', ['room'])
+danmaku_heartbeat_seconds = Summary('timelapse_danmaku_heartbeat_seconds', 'Bilibili danmaku heartbeat round trip', ['room'])
+queue_depth = CallbackGauge('timelapse_queue_depth', 'Items waiting in internal queues', ['queue'])
+thread_count = CallbackGauge('timelapse_threads', 'Live threads in the process')
+thread_count.add(threading.active_count)
+
+DOWNLOAD_STALL_THRESHOLD = 5
+
+def download_written(download: str, size: int, now: float, last_write: float):
+    download_bytes.inc(size, download=download)
+    download_last_write.set(now, download=download)
+    if last_write and now - last_write > DOWNLOAD_STALL_THRESHOLD:
+        download_stall_seconds.observe(now - last_write, download=download)
+
+def download_finished(download: str):
+    for metric in (download_bytes, download_last_write, download_stall_seconds, download_queued):
+        metric.remove(download=download)
+
+
+class MetricsServer:
+    def __init__(self, server_addr: Tuple[str, int]):
+        self.server = http.server.ThreadingHTTPServer(server_addr, MetricsHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        logger.info(f'Serving metrics on {server_addr[0]}:{server_addr[1]}')
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass  # scraped every few seconds
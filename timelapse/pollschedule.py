@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+import threading
+import time
+from collections import OrderedDict
+
+class RateBudget:
+    def __init__(self, requests_per_minute: float):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1.0, requests_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+    def reserve(self) -> float:
+        # takes one request from the budget, returns how long the caller has to wait for it
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class AdaptivePollSchedule:
+    def __init__(
+        self,
+        interval: float,
+        *,
+        min_interval: float,
+        max_interval: float,
+        window: float = 1800,
+        history: int = 32,
+    ):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.window = window
+        self.history = history
+        self.starts = OrderedDict()
+        self.lock = threading.Lock()
+    def observe(self, key, timestamp: float):
+        with self.lock:
+            self.starts[key] = timestamp
+            self.starts.move_to_end(key)
+            while len(self.starts) > self.history:
+                self.starts.popitem(last=False)
+    def next_interval(self, now: float) -> float:
+        with self.lock:
+            starts = list(self.starts.values())
+        if len(starts) < 2:
+            return self.interval
+        # channels that stream rarely are polled less often
+        days = max(now - min(starts), 86400) / 86400
+        interval = self.interval * days / len(starts)
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        next_window = self.next_window(now, starts)
+        if next_window is not None:
+            if next_window <= now:
+                return self.min_interval
+            interval = min(interval, max(next_window - now, self.min_interval))
+        return interval
+    def next_window(self, now: float, starts):
+        # earliest likely start window, from times of day that were used at least twice
+        day = now - now % 86400
+        times = [t % 86400 for t in starts]
+        best = None
+        for t in times:
+            support = sum(1 for o in times if min(abs(o - t), 86400 - abs(o - t)) <= self.window)
+            if support < 2:
+                continue
+            start = day + t
+            if start + self.window < now:
+                start += 86400
+            start -= self.window
+            if best is None or start < best:
+                best = start
+        return best
+
+
+_poll_budget = RateBudget(60)
+
+def set_poll_budget(requests_per_minute: float):
+    global _poll_budget
+    _poll_budget = RateBudget(requests_per_minute)
+
+def get_poll_budget() -> RateBudget:
+    return _poll_budget
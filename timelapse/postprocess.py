@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+import os
+import re
+import json
+import queue
+import shutil
+import subprocess
+import threading
+import concurrent.futures
+from typing import Optional
+
+from . import metrics
+from .logger import logger
+from .status import status_add_watch
+
+def pp_concat(dirpath: str, key: str, path: Optional[str]) -> Optional[str]:
+    # rotated recordings are stored as [<key>.]<timestamp>.ts parts
+    part_re = re.compile(r'(?:' + re.escape(key) + r'\.)?(\d+)\.ts$')
+    if not os.path.isdir(dirpath):
+        return path
+    parts = []
+    for name in os.listdir(dirpath):
+        match = part_re.match(name)
+        if match:
+            parts.append((int(match.group(1)), name))
+    parts.sort()
+    if not parts:
+        return path
+    if len(parts) == 1:
+        return os.path.join(dirpath, parts[0][1])
+    # keys of url watchers are urls, name those after the parts instead, the
+    # .concat.ts suffix keeps a numeric key such as a room id from matching part_re
+    name = key if re.fullmatch(r'[\w.-]+', key) else f'{parts[0][0]}-{parts[-1][0]}'
+    outpath = os.path.join(dirpath, name + '.concat.ts')
+    tmppath = outpath + '.part'
+    with open(tmppath, 'wb') as outfile:
+        for _, name in parts:
+            with open(os.path.join(dirpath, name), 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, 1 << 20)
+    os.replace(tmppath, outpath)
+    return outpath
+
+def pp_remux(dirpath: str, key: str, path: Optional[str]) -> Optional[str]:
+    if not path or path.endswith('.mp4'):
+        return path
+    outpath = os.path.splitext(path)[0] + '.mp4'
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'warning', '-i', path, '-c', 'copy', '-f', 'mp4', outpath + '.part'],
+        check=True,
+        stdin=subprocess.DEVNULL,
+    )
+    os.replace(outpath + '.part', outpath)
+    return outpath
+
+PP_STAGES = {
+    'concat': pp_concat,
+    'remux': pp_remux,
+}
+
+def _pp_worker_init(nice: int):
+    os.nice(nice)
+
+
+class PostProcessor:
+    def __init__(
+        self,
+        stages = ('concat', 'remux'),
+        *,
+        workers: int = 1,
+        queue_size: int = 64,
+        journal: Optional[str] = None,
+        retry_count: int = 3,
+        retry_interval: int = 300,
+        nice: int = 10,
+        only_finished: bool = False,
+    ):
+        self.stages = [PP_STAGES[s] if isinstance(s, str) else s for s in stages]
+        self.journal = journal
+        self.retry_count = retry_count
+        self.retry_interval = retry_interval
+        self.only_finished = only_finished
+        # a full queue blocks the finishing recorder instead of piling up work
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = []
+        self.running = 0
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_pp_worker_init,
+            initargs=(nice,),
+        )
+        self.threads = [threading.Thread(target=self.run_jobs) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+        if journal and os.path.exists(journal):
+            with open(journal) as f:
+                for job in json.load(f):
+                    logger.info(f'Resuming post processing of {job["key"]}')
+                    self.enqueue(job, save=False)
+        metrics.queue_depth.add(self.queue.qsize, queue='postprocess')
+        status_add_watch(self)
+    def __call__(self, key, dirpath: str, finished: bool):
+        if self.only_finished and not finished:
+            return
+        if not os.path.isdir(dirpath):
+            # e.g. a video that ended or was uploaded before anything was recorded
+            logger.debug(f'Nothing to post process for {key}')
+            return
+        self.enqueue({
+            'key': str(key),
+            'dirpath': dirpath,
+            'finished': finished,
+            'stage': 0,
+            'path': None,
+            'attempts': 0,
+        })
+    def enqueue(self, job, save: bool = True):
+        with self.lock:
+            self.jobs.append(job)
+        if save:
+            self.save()
+        self.queue.put(job)
+    def save(self):
+        if not self.journal:
+            return
+        with self.lock:
+            with open(self.journal + '.tmp', 'w') as f:
+                json.dump(self.jobs, f)
+            os.replace(self.journal + '.tmp', self.journal)
+    def run_jobs(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                self.running += 1
+            try:
+                while job['stage'] < len(self.stages):
+                    stage = self.stages[job['stage']]
+                    job['path'] = self.pool.submit(stage, job['dirpath'], job['key'], job['path']).result()
+                    job['stage'] += 1
+                    self.save()
+                logger.info(f'Post processing finished for {job["key"]}: {job["path"]}')
+                with self.lock:
+                    self.jobs.remove(job)
+                self.save()
+            except:
+                logger.exception(f'Post processing failed for {job["key"]}')
+                job['attempts'] += 1
+                if job['attempts'] < self.retry_count:
+                    threading.Timer(self.retry_interval, self.queue.put, (job,)).start()
+                else:
+                    with self.lock:
+                        self.jobs.remove(job)
+                    self.save()
+            finally:
+                with self.lock:
+                    self.running -= 1
+    def status(self):
+        return [f'Post processing: {len(self.jobs) - self.running} pending, {self.running} running']
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+import collections
+import functools
+import signal
+import sys
+import threading
+import time
+from typing import Optional
+
+from .logger import logger
+from .eventloop import EventLoop, get_event_loop
+
+_enabled = False
+_summary_timer_handle = None
+_stats = {}  # name -> [count, total, max]
+_stats_lock = threading.Lock()
+
+class _Span:
+    __slots__ = ('name', 'start')
+    def __init__(self, name: str):
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _stats_lock:
+            stat = _stats.get(self.name)
+            if stat is None:
+                _stats[self.name] = [1, elapsed, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+                if elapsed > stat[2]:
+                    stat[2] = elapsed
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name: str):
+    # a shared no-op is handed out while profiling is off
+    return _Span(name) if _enabled else _NULL_SPAN
+
+def profiled(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def profiling_summary(reset: bool = True):
+    with _stats_lock:
+        stats = sorted(_stats.items(), key=lambda item: -item[1][1])
+        if reset:
+            _stats.clear()
+    return [
+        f'{name}: {count} calls, {total * 1000:.1f}ms total, '
+        f'{total / count * 1000:.3f}ms avg, {peak * 1000:.3f}ms max'
+        for name, (count, total, peak) in stats
+    ]
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.01, depth: int = 8, top: int = 20):
+        self.interval = interval
+        self.depth = depth
+        self.top = top
+        self.samples = collections.Counter()
+        self.thread = None
+        self.running = False
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='timelapse-profiler', daemon=True)
+        self.thread.start()
+        logger.info('Sampling profiler started')
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        logger.info(' ===== PROFILE =====')
+        total = sum(self.samples.values()) or 1
+        for stack, count in self.samples.most_common(self.top):
+            logger.info(f'[profile] {count * 100 / total:5.1f}% {stack}')
+        logger.info(' ===== END PROFILE =====')
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+    def run(self):
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name}({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                    frame = frame.f_back
+                self.samples[' < '.join(stack)] += 1
+            time.sleep(self.interval)
+
+_profiler = SamplingProfiler()
+
+def _summary_timer(loop: EventLoop, interval: float):
+    global _summary_timer_handle
+    lines = profiling_summary()
+    if lines:
+        logger.info(' ===== TIMING SUMMARY =====')
+        for line in lines:
+            logger.info(f'[timing] {line}')
+        logger.info(' ===== END TIMING SUMMARY =====')
+    _summary_timer_handle = loop.call_later(interval, _summary_timer, loop, interval)
+
+def enable_profiling(
+    summary_interval: float = 300,
+    *,
+    profile_signal: Optional[int] = getattr(signal, 'SIGUSR2', None),
+    loop: Optional[EventLoop] = None,
+):
+    global _enabled, _summary_timer_handle
+    if _enabled:
+        return
+    _enabled = True
+    loop = loop or get_event_loop()
+    _summary_timer_handle = loop.call_later(summary_interval, _summary_timer, loop, summary_interval)
+    if profile_signal is not None:
+        # the sampling profiler is switched on and off with e.g. kill -USR2 <pid>
+        signal.signal(profile_signal, lambda signum, frame: loop.call_soon_threadsafe(_profiler.toggle))
+
+def disable_profiling():
+    global _enabled, _summary_timer_handle
+    _enabled = False
+    if _summary_timer_handle:
+        _summary_timer_handle.cancel()
+        _summary_timer_handle = None
+    _profiler.stop()
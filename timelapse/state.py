@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+import json
+import sqlite3
+import threading
+
+class StateStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+    def get(self, namespace: str, key: str, default = None):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM state WHERE namespace = ? AND key = ?',
+                (namespace, key),
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+    def set(self, namespace: str, key: str, value):
+        data = json.dumps(value)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)',
+                (namespace, key, data),
+            )
+    def delete(self, namespace: str, key: str):
+        with self.lock:
+            self.conn.execute(
+                'DELETE FROM state WHERE namespace = ? AND key = ?',
+                (namespace, key),
+            )
+    def items(self, namespace: str):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT key, value FROM state WHERE namespace = ?',
+                (namespace,),
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+import ctypes
+import ctypes.util
+import os
+import heapq
+import itertools
+import shutil
+import threading
+import time
+from typing import Optional
+
+from . import metrics
+from .logger import logger
+from .status import status_add_watch
+
+class StorageRecording:
+    def __init__(self, manager, dirpath: str, priority: int):
+        self.manager = manager
+        self.dirpath = dirpath
+        self.device = os.stat(dirpath).st_dev
+        self.priority = priority
+        self.started = time.time()
+        self.written_bytes = 0
+        self.allocated_bytes = 0
+        self.path = None
+    def bitrate(self) -> float:
+        elapsed = time.time() - self.started
+        if elapsed < 10 or not self.written_bytes:
+            return self.manager.default_bitrate
+        return self.written_bytes / elapsed
+    def written(self, outfile, size: int):
+        self.path = outfile.name
+        self.written_bytes += size
+        if self.written_bytes > self.allocated_bytes and _fallocate and self.manager.extent_size:
+            # reserve large extents ahead of the data to keep the file contiguous on disk,
+            # the file size still only covers what was written
+            extent = max(self.manager.extent_size, self.written_bytes - self.allocated_bytes)
+            try:
+                _fallocate(outfile.fileno(), self.allocated_bytes, extent)
+                self.allocated_bytes += extent
+            except OSError as e:
+                logger.debug(f'Preallocation failed: {e}')
+                self.allocated_bytes = self.written_bytes
+    def release(self):
+        # hand the unused blocks of the last extent back, the file is closed by now
+        if self.path and self.allocated_bytes > self.written_bytes:
+            try:
+                os.truncate(self.path, self.written_bytes)
+            except OSError as e:
+                logger.error(f'Failed to truncate {self.path}: {e}')
+        self.manager.release(self)
+
+class StorageManager:
+    def __init__(
+        self,
+        *,
+        reserve_bytes: int = 0,
+        horizon: int = 0,
+        default_bitrate: int = 1 << 20,
+        extent_size: int = 64 << 20,
+        admit_timeout: int = 300,
+    ):
+        # a recording needs at least one extent of free space to be admitted,
+        # set reserve_bytes and horizon to keep more room than that
+        self.reserve_bytes = reserve_bytes
+        self.horizon = horizon
+        self.default_bitrate = default_bitrate
+        self.extent_size = extent_size
+        self.admit_timeout = admit_timeout
+        self.recordings = set()
+        self.waiting = {}  # device -> heap of tickets, disks are admitted independently
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        metrics.queue_depth.add(self.waiting_count, queue='storage-admission')
+        status_add_watch(self)
+    def headroom(self) -> int:
+        return max(self.reserve_bytes, self.extent_size)
+    def waiting_count(self) -> int:
+        return sum(len(waiting) for waiting in self.waiting.values())
+    def projected_free(self, dirpath: str, device: int) -> float:
+        # free space left after every active recording on the same disk runs for another horizon
+        free = shutil.disk_usage(dirpath).free
+        for rec in self.recordings:
+            if rec.device == device:
+                free -= max(0, rec.bitrate() * self.horizon - (rec.allocated_bytes - rec.written_bytes))
+        return free - self.default_bitrate * self.horizon
+    def admit(self, dirpath: str, priority: int = 0, timeout: Optional[float] = None) -> Optional[StorageRecording]:
+        deadline = time.time() + (self.admit_timeout if timeout is None else timeout)
+        ticket = (-priority, next(self.seq))
+        device = os.stat(dirpath).st_dev
+        with self.cond:
+            waiting = self.waiting.setdefault(device, [])
+            heapq.heappush(waiting, ticket)
+            try:
+                while True:
+                    # only the highest priority waiter of the disk is admitted when space frees up
+                    if waiting[0] == ticket and self.projected_free(dirpath, device) > self.headroom():
+                        rec = StorageRecording(self, dirpath, priority)
+                        self.recordings.add(rec)
+                        return rec
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        logger.error(f'Not enough disk space to record into {dirpath}')
+                        return None
+                    self.cond.wait(min(remaining, 10))
+            finally:
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+                if not waiting:
+                    del self.waiting[device]
+                self.cond.notify_all()
+    def release(self, rec: StorageRecording):
+        with self.cond:
+            self.recordings.discard(rec)
+            self.cond.notify_all()
+    def status(self):
+        with self.cond:
+            return [
+                f'Storage: {len(self.recordings)} recordings, {self.waiting_count()} waiting, '
+                f'{sum(rec.bitrate() for rec in self.recordings) / 1024:.0f} KiB/s'
+            ]
+
+
+FALLOC_FL_KEEP_SIZE = 1
+
+def _load_fallocate():
+    # fallocate(2) with FALLOC_FL_KEEP_SIZE allocates blocks past the end of the file
+    # without changing its size, os.posix_fallocate would pad the file with zeros
+    # that stay behind if the process dies before release()
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    def fallocate_keep_size(fd: int, offset: int, length: int):
+        if fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    return fallocate_keep_size
+
+_fallocate = _load_fallocate()
+
+_storage_manager = None
+_storage_manager_lock = threading.Lock()
+
+def configure_storage_manager(**kwargs) -> StorageManager:
+    global _storage_manager
+    with _storage_manager_lock:
+        _storage_manager = StorageManager(**kwargs)
+        return _storage_manager
+
+def get_storage_manager() -> StorageManager:
+    global _storage_manager
+    with _storage_manager_lock:
+        if not _storage_manager:
+            _storage_manager = StorageManager()
+        return _storage_manager
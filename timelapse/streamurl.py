@@ -1,14 +1,75 @@
 #!/usr/bin/python3
 import threading
 import time
-import random
 import os
+from datetime import datetime
+from typing import Optional
 from tzcron import Schedule
 
 from .logger import logger
-from .downloader import StreamlinkDownloader
+from .downloader import StreamlinkDownloader, downloader_accepts, get_downloader
+from .eventloop import EventLoop, get_event_loop
 from .status import status_add_watch
 
+class StreamUrlRun:
+    def __init__(self, watcher, start: datetime, start_at: Optional[float]):
+        self.watcher = watcher
+        self.start = start
+        self.end = start.timestamp() + watcher.duration
+        self.start_at = start_at
+        self.dirpath = os.path.join(watcher.download_path, start.strftime('%Y%m%d_%H%M%S_%Z'))
+        self.dl_handle = None
+        self.finished = False
+        self.timer = None
+    def launch(self):
+        watcher = self.watcher
+        os.makedirs(self.dirpath, exist_ok=True)
+        run_start_hook = self.dl_handle is None
+        kwargs = {}
+        if self.start_at and self.start_at > time.time():
+            if downloader_accepts(watcher.downloader, 'start_at'):
+                kwargs['start_at'] = self.start_at
+            else:
+                logger.debug(f'Downloader of {watcher.url} has no start_at, the overlap is recorded twice')
+        self.dl_handle = watcher.downloader(watcher.url, dirpath=self.dirpath, **kwargs)
+        if run_start_hook and watcher.started_download:
+            watcher.loop.run_in_executor(watcher.started_download, watcher.url, self.dirpath)
+        self.schedule_check()
+    def schedule_check(self):
+        self.timer = self.watcher.loop.call_at(
+            min(time.time() + self.watcher.scheduler_interval, self.end),
+            self.check,
+        )
+    def check(self):
+        try:
+            if time.time() >= self.end:
+                self.stop()
+                return
+            if not self.dl_handle.is_running():
+                logger.warning(f'Downloader aborted: {self.watcher.url}')
+                self.launch()
+                return
+        except:
+            logger.exception(f'Unknown error')
+        self.schedule_check()
+    def stop(self):
+        logger.info(f'Stopping downloader {self.watcher.url}')
+        if self.dl_handle.is_running():
+            self.dl_handle.interrupt()
+            self.finished = True
+        self.watcher.runs.remove(self)
+        threading.Thread(target=self.finish).start()
+    def finish(self):
+        try:
+            self.dl_handle.wait(45)
+        finally:
+            self.dl_handle.kill()
+            if self.watcher.post_download:
+                try:
+                    self.watcher.post_download(self.watcher.url, self.dirpath, self.finished)
+                except:
+                    logger.exception('Post download hook error')
+
 class StreamUrlWatcher:
     def __init__(
         self,
@@ -18,73 +79,52 @@ class StreamUrlWatcher:
         duration: int,
         *,
         scheduler_interval: int = 15,
+        preroll: int = 0,
+        downloader = StreamlinkDownloader,
         started_download = None,
         post_download = None,
+        loop: Optional[EventLoop] = None,
     ):
         logger.info(f'Monitoring URL {url}')
         self.url = url
         self.download_path = download_path
         self.duration = duration
         self.schedule = schedule
+        self.schedule_iter = iter(schedule)
         self.scheduler_interval = scheduler_interval
+        self.preroll = preroll
+        self.downloader = get_downloader(downloader)
         self.started_download = started_download
         self.post_download = post_download
-        self.dl_handle = None
-        self.finished = False
+        self.loop = loop or get_event_loop(url)
+        self.runs = []
         self.next_run = None
-        self.thread = threading.Thread(target=self.mainloop)
-        self.thread.start()
         status_add_watch(self)
-    def mainloop(self):
-        for next_run in self.schedule:
-            self.next_run = next_run
-            try:
-                sec = next_run.timestamp() - time.time()
-                while sec > -self.duration:
-                    if sec > 3600:
-                        time.sleep(3600 - 120 + random.randrange(60))
-                    elif sec > self.scheduler_interval + 1:
-                        time.sleep(self.scheduler_interval)
-                    elif sec > 0:
-                        time.sleep(sec)
-                    else:
-                        logger.info(f'URL stream started: {self.url}')
-                        dirpath = os.path.join(self.download_path, next_run.strftime('%Y%m%d_%H%M%S_%Z'))
-                        os.makedirs(dirpath, exist_ok=True)
-                        self.finished = False
-                        run_start_hook = self.dl_handle is None
-                        self.dl_handle = StreamlinkDownloader(
-                            self.url,
-                            dirpath=dirpath,
-                        )
-                        if run_start_hook and self.started_download:
-                            try:
-                                self.started_download(self.url, dirpath)
-                            except:
-                                logger.exception(f'Started download hook error')
-                        self.dl_handle.wait(self.duration + sec)
-                        if self.dl_handle.is_running():
-                            logger.info(f'Stopping downloader {self.url}')
-                            self.dl_handle.interrupt()
-                            self.finished = True
-                            break
-                        else:
-                            logger.warn(f'Downloader aborted: {self.url}')
-                        self.dl_handle.wait()
-                    sec = next_run.timestamp() - time.time()
-            except:
-                logger.exception(f'Unknown error')
-            finally:
-                if self.dl_handle:
-                    self.dl_handle.kill()
-                    self.dl_handle = None
-                    if self.post_download:
-                        try:
-                            self.post_download(self.url, dirpath, self.finished)
-                        except:
-                            logger.exception('Post download hook error')
+        self.loop.call_soon_threadsafe(self.schedule_next)
+    def schedule_next(self):
+        for next_run in self.schedule_iter:
+            if next_run.timestamp() + self.duration > time.time():
+                break
+        else:
+            self.next_run = None
+            return
+        self.next_run = next_run
+        self.loop.call_at(next_run.timestamp() - self.preroll, self.start_run, next_run)
+    def start_run(self, start: datetime):
+        logger.info(f'URL stream started: {self.url}')
+        # a run that is still recording keeps going until its end, the new
+        # one connects now but only writes from there on
+        handoff = max((run.end for run in self.runs), default=None)
+        run = StreamUrlRun(self, start, handoff)
+        try:
+            run.launch()
+            self.runs.append(run)
+        except:
+            logger.exception(f'Unknown error')
+        finally:
+            self.schedule_next()
     def status(self):
         return [
             f'URL Stream {self.url} scheduled at {self.next_run} '
-            + ('[recording]' if self.dl_handle else '[idle]')
-        ]
\ No newline at end of file
+            + ('[recording]' if self.runs else '[idle]')
+        ]
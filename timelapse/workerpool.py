@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+import multiprocessing
+import signal
+import threading
+from collections import deque
+
+from .logger import logger
+from .status import status_add_watch
+
+# imported once by the fork server, so every worker starts with them loaded
+DOWNLOAD_WORKER_PRELOAD = ('youtube_dl', 'you_get.common', 'you_get.extractors', 'timelapse.downloader')
+
+def _worker_control(conn):
+    try:
+        while True:
+            command = conn.recv()
+            if command == 'stop':
+                # interrupts the job running in the main thread with KeyboardInterrupt
+                signal.raise_signal(signal.SIGINT)
+    except (EOFError, OSError):
+        pass
+
+def _worker_main(conn):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        command, target, args = conn.recv()
+    except (EOFError, OSError):
+        return  # pool went away before handing out a job
+    threading.Thread(target=_worker_control, args=(conn,), daemon=True).start()
+    target(*args)
+
+class DownloadWorker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        # workers are single use, a job may leave the extractor modules in any state
+        self.proc = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.proc.start()
+        child_conn.close()
+    def run(self, target, args):
+        self.conn.send(('run', target, args))
+    def stop(self):
+        try:
+            self.conn.send('stop')
+        except (BrokenPipeError, OSError):
+            pass
+
+class DownloadWorkerPool:
+    def __init__(self, size: int = 2, preload = DOWNLOAD_WORKER_PRELOAD):
+        # workers re-import the main script like multiprocessing spawn does, so
+        # the script needs an if __name__ == '__main__' guard around its setup
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self.ctx = multiprocessing.get_context('forkserver')
+            self.ctx.set_forkserver_preload(list(preload))
+        else:
+            self.ctx = multiprocessing.get_context()
+        self.size = size
+        self.idle = deque()
+        self.warming = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.warm).start()
+        status_add_watch(self)
+    def warm(self):
+        with self.lock:
+            if self.warming:
+                return
+            self.warming = True
+        while True:
+            with self.lock:
+                if len(self.idle) >= self.size:
+                    self.warming = False
+                    return
+            try:
+                worker = DownloadWorker(self.ctx)
+            except:
+                logger.exception('Failed to start download worker')
+                with self.lock:
+                    self.warming = False
+                return
+            with self.lock:
+                self.idle.append(worker)
+    def submit(self, target, *args) -> DownloadWorker:
+        worker = None
+        with self.lock:
+            while self.idle and not worker:
+                worker = self.idle.popleft()
+                if not worker.proc.is_alive():
+                    worker = None
+        if not worker:
+            worker = DownloadWorker(self.ctx)
+        worker.run(target, args)
+        threading.Thread(target=self.warm).start()
+        return worker
+    def status(self):
+        return [f'Download workers: {len(self.idle)} idle']
+
+
+_download_worker_pool = None
+_download_worker_pool_lock = threading.Lock()
+
+def configure_download_worker_pool(**kwargs) -> DownloadWorkerPool:
+    global _download_worker_pool
+    with _download_worker_pool_lock:
+        _download_worker_pool = DownloadWorkerPool(**kwargs)
+        return _download_worker_pool
+
+def get_download_worker_pool() -> DownloadWorkerPool:
+    global _download_worker_pool
+    with _download_worker_pool_lock:
+        if not _download_worker_pool:
+            _download_worker_pool = DownloadWorkerPool()
+        return _download_worker_pool
@@ -1,25 +1,28 @@
 #!/usr/bin/python3
-import youtube_dl
 import time
 import subprocess
 import os
-import objectpath
 import re
-import requests
 import sys
 import logging
-import itertools
 import threading
 import json
-import http
+import http.server
+import queue
 import urllib.parse
 import xml.etree.ElementTree as ET
-from collections import deque
+from collections import OrderedDict
 from datetime import datetime
 from typing import Tuple, Optional
 
+from . import metrics
 from .logger import logger
-from .downloader import StreamlinkDownloader
+from .downloader import StreamlinkDownloader, downloader_accepts, get_downloader, prewarm_connections
+from .eventloop import EventLoop, get_event_loop
+from .httpclient import get_http_client
+from .pollschedule import AdaptivePollSchedule, get_poll_budget
+from .profiling import profiled, span
+from .state import StateStore
 from .status import status_add_watch
 
 YOUTUBE_CLIENT_VERSION = '2.20200623.04.00'
@@ -33,6 +36,10 @@ YOUTUBE_VIDEO_URL = 'https://www.youtube.com/watch?v={video_id}'
 YOUTUBE_FEED_HUB = 'https://pubsubhubbub.appspot.com'
 YOUTUBE_CHANNEL_FEED_URL = 'https://www.youtube.com/xml/feeds/videos.xml?channel_id={channel_id}'
 YOUTUBE_URL_EXPIRE = 3600 * 6
+YOUTUBE_LEASE_SECONDS = 86400 * 5
+# hosts a live download talks to first, connected to ahead of the scheduled start
+YOUTUBE_PREWARM_URLS = ('https://www.youtube.com/', 'https://manifest.googlevideo.com/')
+YOUTUBE_PREWARM_REFRESH = 60
 
 
 class YoutubeChannelWatcher:
@@ -46,50 +53,96 @@ class YoutubeChannelWatcher:
         upcoming_poll_start: int = 300,
         poll_mode: bool = False,
         poll_interval: int = 900,
+        min_poll_interval: int = 120,
+        max_poll_interval: int = 3 * 3600,
+        adaptive_poll: bool = True,
         webhook = None,
         downloader = StreamlinkDownloader,
         started_download = None,
         post_download = None,
+        loop: Optional[EventLoop] = None,
+        state: Optional[StateStore] = None,
+        autostart: bool = True,
     ):
         self.channel_id = channel_id
         self.title_filter = re.compile(title_filter) if title_filter else None
         self.heartbeat_interval = heartbeat_interval
         self.upcoming_poll_start = upcoming_poll_start
         self.download_path = download_path
-        self.downloader = downloader
+        self.downloader = get_downloader(downloader)
         self.started_download = started_download
         self.post_download = post_download
-        self.tracking = {}
-        self.cleanup_queue = deque()
+        self.loop = loop or get_event_loop()
+        self.tracking = TrackingRegistry(loop=self.loop)
         self.lock = threading.RLock()
         self.name = '<loading>'
-        # repeated poll in polling mode
-        if poll_mode:
-            logger.info(f'Monitoring channel {channel_id} using polling')
-            self.poll_thread = threading.Thread(target=self.run_poll, args=(poll_interval,))
-            self.poll_thread.start()
-        else:
-            assert webhook
-        if webhook:
-            logger.info(f'Monitoring channel {channel_id} using webhook')
-            webhook.subscribe(channel_id, self)
+        self.last_poll = 0
+        self.state = state
+        self.poll_interval = poll_interval
+        self.poll_schedule = AdaptivePollSchedule(
+            poll_interval,
+            min_interval=min_poll_interval,
+            max_interval=max_poll_interval,
+        ) if adaptive_poll else None
+        if state:
+            self.restore_state()
+        self.poll_mode = poll_mode
+        self.webhook = webhook
+        assert poll_mode or webhook
         status_add_watch(self)
-        # initial poll
-        try:
-            self.poll()
-        except:
-            logger.exception('Polling error')
+        if autostart:
+            self.start()
+
+    def start(self):
+        # repeated poll in polling mode
+        if self.poll_mode:
+            logger.info(f'Monitoring channel {self.channel_id} using polling')
+            self.schedule_channel_poll()
+        if self.webhook:
+            logger.info(f'Monitoring channel {self.channel_id} using webhook')
+            self.webhook.subscribe(self.channel_id, self)
+        # initial poll, unless the saved one is still recent
+        if time.time() - self.last_poll >= self.poll_interval:
+            try:
+                self.poll()
+            except:
+                logger.exception('Polling error')
+
+    def restore_state(self):
+        saved = self.state.get('youtube.channel', self.channel_id, {})
+        self.name = saved.get('name', self.name)
+        self.last_poll = saved.get('last_poll', 0)
+        if self.poll_schedule:
+            for video_id, started in saved.get('live_starts', []):
+                self.poll_schedule.observe(video_id, started)
+        for video_id, video in self.state.items('youtube.video'):
+            if video['channel_id'] == self.channel_id:
+                self.watch_video(video_id, video['title'])
+
+    def save_state(self):
+        if self.state:
+            live_starts = []
+            if self.poll_schedule:
+                with self.poll_schedule.lock:
+                    live_starts = list(self.poll_schedule.starts.items())
+            self.state.set('youtube.channel', self.channel_id, {
+                'name': self.name,
+                'last_poll': self.last_poll,
+                'live_starts': live_starts,
+            })
 
     def watch_video(self, video_id: str, title: str):
         with self.lock:
             if video_id in self.tracking:
-                self.tracking[video_id].force_refresh = True
+                recorder = self.tracking.get(video_id)
+                if recorder:
+                    recorder.refresh()
             else:
                 if self.title_filter and not self.title_filter.search(title):
                     logger.debug(f'Filtering out {video_id}: {title}')
                     return
                 logger.info(f'Found {video_id}: {title}')
-                self.tracking[video_id] = YoutubeLivestreamRecorder(
+                self.tracking.add(video_id, YoutubeLivestreamRecorder(
                     video_id=video_id,
                     title=title,
                     download_path=self.download_path,
@@ -99,30 +152,30 @@ class YoutubeChannelWatcher:
                     downloader=self.downloader,
                     started_download=self.started_download,
                     post_download=self.post_download,
-                )
+                    loop=self.loop,
+                    state=self.state,
+                ))
 
     def finish_tracking(self, video_id: str, delay: bool):
-        if delay:
-            self.cleanup_queue.append((video_id, time.time() + 3600 * 6))
-        else:
-            with self.lock:
-                del self.tracking[video_id]
+        # finished videos are remembered for a while so that they are not tracked again
+        with self.lock:
+            self.tracking.finish(video_id, delay)
 
     def poll(self):
         logger.debug(f'Polling channel {self.channel_id}')
-        channel_data = requests.get(
+        resp = get_http_client().get(
             YOUTUBE_CHANNEL_DATA.format(channel_id=self.channel_id),
+            endpoint='youtube_channel',
             headers=YOUTUBE_COMMON_HEADERS
-        ).json()
+        )
+        with span('youtube.channel.json'):
+            channel_data = resp.json()
         logger.debug(channel_data)
-        optree = objectpath.Tree(channel_data)
-        self.name = next(optree.execute('$..channelMetadataRenderer.title'))
+        name, videos = youtube_extract_channel(channel_data)
+        if name is not None:
+            self.name = name
         pollres = set()
-        for video_data in itertools.chain(
-            #optree.execute(f'$..*[int(@.upcomingEventData.startTime) > 0]'),
-            optree.execute('$..*["LIVE" in @.thumbnailOverlays..style]'),
-            optree.execute('$..*["UPCOMING" in @.thumbnailOverlays..style]'),
-        ):
+        for video_data in videos:
             video_id = video_data['videoId']
             if "runs" in video_data["title"]:
                 title = video_data["title"]["runs"][0]["text"]
@@ -132,18 +185,37 @@ class YoutubeChannelWatcher:
         for video_id, title in pollres:
             logger.debug(f'Polling found {video_id}')
             self.watch_video(video_id, title)
+        self.last_poll = time.time()
+        self.save_state()
+
+    def observe_stream(self, video_id: str, start_time: float):
+        if self.poll_schedule:
+            self.poll_schedule.observe(video_id, start_time)
+            self.save_state()
+
+    def schedule_channel_poll(self):
+        if self.poll_schedule:
+            interval = self.poll_schedule.next_interval(time.time())
+        else:
+            interval = self.poll_interval
+        self.loop.call_later(interval, self.dispatch_channel_poll)
+
+    def dispatch_channel_poll(self, reserved: bool = False):
+        if not reserved:
+            wait = get_poll_budget().reserve()
+            if wait > 0:
+                self.loop.call_later(wait, self.dispatch_channel_poll, True)
+                return
+        self.loop.run_in_executor(self.run_poll)
+
+    def run_poll(self):
+        try:
+            self.poll()
+        except:
+            logger.exception('Polling error')
+        finally:
+            self.schedule_channel_poll()
 
-    def run_poll(self, interval: int):
-        while True:
-            try:
-                time.sleep(interval)
-                self.poll()
-                with self.lock:
-                    while self.cleanup_queue and self.cleanup_queue[0][1] >= time.time():
-                        del self.tracking[self.cleanup_queue.popleft()[0]]
-            except:
-                logger.exception('Polling error')
-    
     def status(self):
         return [
             f'Youtube Channel {self.name} (https://youtube.com/channel/{self.channel_id})',
@@ -151,6 +223,62 @@ class YoutubeChannelWatcher:
         ]
 
 
+class TrackingRegistry:
+    def __init__(
+        self,
+        ttl: float = 3600 * 6,
+        maxsize: int = 1024,
+        loop: Optional[EventLoop] = None,
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.loop = loop or get_event_loop()
+        self.active = {}
+        # finished video id -> expiry, in expiry order since ttl is constant
+        self.finished = OrderedDict()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __contains__(self, video_id: str):
+        with self.lock:
+            return video_id in self.active or video_id in self.finished
+
+    def __len__(self):
+        return len(self.active) + len(self.finished)
+
+    def get(self, video_id: str):
+        return self.active.get(video_id)
+
+    def add(self, video_id: str, recorder):
+        with self.lock:
+            self.finished.pop(video_id, None)
+            self.active[video_id] = recorder
+
+    def finish(self, video_id: str, delay: bool):
+        with self.lock:
+            self.active.pop(video_id, None)
+            if not delay:
+                return
+            self.finished[video_id] = time.time() + self.ttl
+            while self.finished and len(self.active) + len(self.finished) > self.maxsize:
+                self.finished.popitem(last=False)
+            if self.finished and not self.timer:
+                self.timer = self.loop.call_at(next(iter(self.finished.values())), self.expire)
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            while self.finished and next(iter(self.finished.values())) <= now:
+                self.finished.popitem(last=False)
+            self.timer = None
+            if self.finished:
+                self.timer = self.loop.call_at(next(iter(self.finished.values())), self.expire)
+
+    def values(self):
+        with self.lock:
+            return list(self.active.values())
+
+
 class YoutubeLivestreamRecorder:
     def __init__(
         self,
@@ -164,6 +292,10 @@ class YoutubeLivestreamRecorder:
         downloader = StreamlinkDownloader,
         started_download = None,
         post_download = None,
+        loop: Optional[EventLoop] = None,
+        state: Optional[StateStore] = None,
+        prewarm_interval: int = 5,
+        prewarm_window: int = 120,
     ):
         logger.info(f'Tracking video {video_id}')
         self.video_id = video_id
@@ -171,8 +303,11 @@ class YoutubeLivestreamRecorder:
         self.channel_watcher = channel_watcher
         self.heartbeat_interval = heartbeat_interval
         self.download_path = os.path.join(download_path, video_id)
-        self.downloader = downloader
+        self.downloader = get_downloader(downloader)
         self.upcoming_poll_start = upcoming_poll_start
+        self.prewarm_interval = prewarm_interval
+        self.prewarm_window = prewarm_window
+        self.prewarmed_at = 0
         self.started_download = started_download
         self.post_download = post_download
         self.scheduled_time = 0
@@ -181,13 +316,36 @@ class YoutubeLivestreamRecorder:
         self.finished = False
         self.cleanup = False
         self.statestr = 'waiting'
-        self.watch_thread = threading.Thread(target=self.run_watch)
-        self.watch_thread.start()
+        self.loop = loop or get_event_loop()
+        self.lock = threading.Lock()
+        self.timer = None
+        self.polling = False
+        self.watch_thread = None
+        self.state = state
+        if state:
+            saved = state.get('youtube.video', video_id)
+            if saved:
+                self.scheduled_time = saved['scheduled_time']
+                self.last_poll = saved['last_poll']
+                self.force_refresh = False
+            else:
+                self.save_state()
+        self.schedule_poll()
+
+    def save_state(self):
+        if self.state:
+            self.state.set('youtube.video', self.video_id, {
+                'channel_id': self.channel_watcher and self.channel_watcher.channel_id,
+                'title': self.title,
+                'scheduled_time': self.scheduled_time,
+                'last_poll': self.last_poll,
+            })
 
     def poll_heartbeat(self):
         logger.debug(f'Polling stream {self.video_id}')
-        status_data = requests.post(
+        resp = get_http_client().post(
             YOUTUBE_LIVE_HEARTBEAT,
+            endpoint='youtube_heartbeat',
             headers=YOUTUBE_COMMON_HEADERS,
             json={
                 "videoId": self.video_id,
@@ -203,58 +361,128 @@ class YoutubeLivestreamRecorder:
                     ]
                 }
             },
-        ).json()
+        )
+        with span('youtube.heartbeat.json'):
+            status_data = resp.json()
         logger.debug(status_data)
         return status_data
 
+    def next_poll_time(self):
+        if self.force_refresh:
+            return time.time()
+        next_poll = self.last_poll + self.heartbeat_interval
+        if abs(self.scheduled_time - self.last_poll) < self.prewarm_window:
+            # poll closely around the scheduled start so going live is noticed quickly
+            next_poll = self.last_poll + self.prewarm_interval
+        elif self.last_poll < self.scheduled_time - self.prewarm_window:
+            next_poll = min(next_poll, self.scheduled_time - self.prewarm_window)
+        # back off while the scheduled start is still far away
+        backoff = self.last_poll + 12 * 3600
+        if self.scheduled_time - backoff < 86400:
+            backoff = max(self.last_poll + 1200, self.scheduled_time - 86400)
+        return max(next_poll, min(self.scheduled_time - self.upcoming_poll_start, backoff))
+
+    def schedule_poll(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            self.timer = self.loop.call_at(self.next_poll_time(), self.dispatch_poll)
+
+    def dispatch_poll(self):
+        with self.lock:
+            self.timer = None
+            if self.polling or self.statestr != 'waiting':
+                return
+            self.polling = True
+        self.loop.run_in_executor(self.run_poll)
+
+    def refresh(self):
+        with self.lock:
+            self.force_refresh = True
+            if self.polling or self.statestr != 'waiting':
+                return
+        self.schedule_poll()
+
+    def run_poll(self):
+        done = False
+        try:
+            done = self.check_upcoming()
+        except:
+            logger.exception('Failed checking video status')
+        finally:
+            with self.lock:
+                # set before polling is released, so a refresh() in between does not poll again
+                if done is None:
+                    self.statestr = 'recording'
+                elif done:
+                    self.statestr = 'finishing'
+                self.polling = False
+        if not done:
+            self.save_state()
+        if done is None:
+            self.watch_thread = threading.Thread(target=self.run_watch)
+            self.watch_thread.start()
+        elif done:
+            self.finish(None)
+        else:
+            self.schedule_poll()
+            self.prewarm()
+
+    def prewarm(self):
+        # get ready for the stream once the scheduled start is near, run on the worker pool
+        now = time.time()
+        if not self.scheduled_time or now < self.scheduled_time - self.upcoming_poll_start:
+            return
+        if now - self.prewarmed_at < YOUTUBE_PREWARM_REFRESH:
+            return
+        self.prewarmed_at = now
+        # the downloader itself was prepared by get_downloader, the stream can
+        # only be resolved once it is live
+        try:
+            prewarm_connections(YOUTUBE_PREWARM_URLS)
+        except:
+            logger.exception(f'Failed to prewarm {self.video_id}')
+
+    def check_upcoming(self):
+        # returns True when there is nothing to record, None when the stream is live
+        self.force_refresh = False
+        self.last_poll = time.time()
+        status_data = self.poll_heartbeat()
+        if 'error' in status_data:
+            logger.error('Server error: ' + status_data['error']['message'])
+            return True
+        status = status_data['playabilityStatus']['status']
+        if status == 'LIVE_STREAM_OFFLINE' and 'liveStreamability' in status_data['playabilityStatus']:
+            renderer = status_data['playabilityStatus']['liveStreamability']['liveStreamabilityRenderer']
+            if 'displayEndscreen' in renderer and renderer['displayEndscreen']:
+                # old recorded live video
+                return True
+            scheduled_time = int(renderer['offlineSlate']['liveStreamOfflineSlateRenderer']['scheduledStartTime'])
+            if self.scheduled_time != scheduled_time:
+                self.scheduled_time = scheduled_time
+                if self.channel_watcher:
+                    self.channel_watcher.observe_stream(self.video_id, scheduled_time)
+                logger.info(f'Video {self.video_id} scheduled at {datetime.fromtimestamp(scheduled_time)}')
+        elif status == 'OK':
+            if 'liveStreamability' not in status_data['playabilityStatus']:
+                # uploaded video, not live
+                return True
+            # start download now
+            return None
+        elif status == 'UNPLAYABLE':
+            # canceled
+            return True
+        else:
+            logger.error(f'Video {self.video_id} unknown status: {status}')
+            return True
+        return False
+
     def run_watch(self):
         ytdl_handle = None
         try:
-            while True:
-                now = time.time()
-                if (
-                    not self.force_refresh
-                    and self.scheduled_time - now > self.upcoming_poll_start
-                    and now - self.last_poll < (
-                        1200 if self.scheduled_time - now < 86400
-                        else 12 * 3600
-                    )
-                ):
-                    time.sleep(self.heartbeat_interval)
-                    continue
-                self.force_refresh = False
-                self.last_poll = now
-                try:
-                    status_data = self.poll_heartbeat()
-                    if 'error' in status_data:
-                        logger.error('Server error: ' + status_data['error']['message'])
-                        return
-                    status = status_data['playabilityStatus']['status']
-                    if status == 'LIVE_STREAM_OFFLINE' and 'liveStreamability' in status_data['playabilityStatus']:
-                        renderer = status_data['playabilityStatus']['liveStreamability']['liveStreamabilityRenderer']
-                        if 'displayEndscreen' in renderer and renderer['displayEndscreen']:
-                            # old recorded live video
-                            return
-                        scheduled_time = int(renderer['offlineSlate']['liveStreamOfflineSlateRenderer']['scheduledStartTime'])
-                        if self.scheduled_time != scheduled_time:
-                            self.scheduled_time = scheduled_time
-                            logger.info(f'Video {self.video_id} scheduled at {datetime.fromtimestamp(scheduled_time)}')
-                    elif status == 'OK':
-                        if 'liveStreamability' not in status_data['playabilityStatus']:
-                            # uploaded video, not live
-                            return
-                        # start download now
-                        break
-                    elif status == 'UNPLAYABLE':
-                        # canceled
-                        return
-                    else:
-                        logger.error(f'Video {self.video_id} unknown status: {status}')
-                        return
-                except:
-                    logger.exception('Failed checking video status')
-                time.sleep(self.heartbeat_interval)
             logger.info(f'Start downloading {self.video_id}')
+            if self.channel_watcher:
+                self.channel_watcher.observe_stream(self.video_id, time.time())
             os.makedirs(self.download_path, exist_ok=True)
             dl_expire = time.time() + YOUTUBE_URL_EXPIRE
             ytdl_handle = self.downloader(
@@ -262,7 +490,6 @@ class YoutubeLivestreamRecorder:
                 self.download_path,
                 self.video_id + '.' + str(int(time.time())),
             )
-            self.statestr = 'recording'
             if self.started_download:
                 try:
                     self.started_download(self.video_id, self.download_path)
@@ -274,13 +501,32 @@ class YoutubeLivestreamRecorder:
                 now = time.time()
                 if now + self.heartbeat_interval >= dl_expire:
                     dl_expire = now + YOUTUBE_URL_EXPIRE
-                    old_handle = ytdl_handle
-                    ytdl_handle = self.downloader(
-                        YOUTUBE_VIDEO_URL.format(video_id=self.video_id),
-                        self.download_path,
-                        self.video_id + '.' + str(int(now)),
-                    )
-                    old_handle.interrupt()
+                    if hasattr(ytdl_handle, 'renew'):
+                        # the downloader switches urls at a segment boundary, in the same file
+                        ytdl_handle.renew()
+                    elif downloader_accepts(self.downloader, 'start_at'):
+                        # the new recording connects now but writes from the splice point on,
+                        # where the old one is stopped. The cut is approximate: the old part
+                        # still writes the read in flight and the two connections are not
+                        # segment aligned, so the byte offset of the cut is recorded
+                        splice_at = now + self.heartbeat_interval
+                        old_handle = ytdl_handle
+                        ytdl_handle = self.downloader(
+                            YOUTUBE_VIDEO_URL.format(video_id=self.video_id),
+                            self.download_path,
+                            self.video_id + '.' + str(int(splice_at)),
+                            start_at=splice_at,
+                        )
+                        logger.info(f'Splicing {self.video_id} into a new recording at {datetime.fromtimestamp(splice_at)}')
+                        self.loop.call_at(splice_at, self.loop.run_in_executor, self.splice, old_handle, ytdl_handle, splice_at)
+                    else:
+                        old_handle = ytdl_handle
+                        ytdl_handle = self.downloader(
+                            YOUTUBE_VIDEO_URL.format(video_id=self.video_id),
+                            self.download_path,
+                            self.video_id + '.' + str(int(now)),
+                        )
+                        old_handle.interrupt()
                 time.sleep(self.heartbeat_interval)
                 try:
                     status_data = self.poll_heartbeat()
@@ -306,17 +552,37 @@ class YoutubeLivestreamRecorder:
         except:
             logger.exception(f'Failed to download {self.video_id}')
         finally:
-            self.cleanup = True
-            if self.channel_watcher:
-                self.channel_watcher.finish_tracking(self.video_id, delay=self.finished)
-            if ytdl_handle and ytdl_handle.is_running():
-                ytdl_handle.kill()
-            if self.post_download:
-                try:
-                    self.post_download(self.video_id, self.download_path, self.finished)
-                except:
-                    logger.exception('Post download hook error')
-            self.statestr = 'invalid'
+            self.finish(ytdl_handle)
+
+    def splice(self, old_handle, new_handle, splice_at: float):
+        old_handle.interrupt()
+        # recorded next to the parts, written_bytes of the old part is where it should be cut
+        splice = {
+            'time': splice_at,
+            'part': getattr(old_handle, 'filename', None),
+            'written_bytes': getattr(old_handle, 'written_bytes', None),
+            'next_part': getattr(new_handle, 'filename', None),
+        }
+        try:
+            with open(os.path.join(self.download_path, self.video_id + '.splices'), 'a') as f:
+                f.write(json.dumps(splice) + '\n')
+        except OSError as e:
+            logger.error(f'Failed to record splice point of {self.video_id}: {e}')
+
+    def finish(self, ytdl_handle):
+        self.cleanup = True
+        if self.state:
+            self.state.delete('youtube.video', self.video_id)
+        if self.channel_watcher:
+            self.channel_watcher.finish_tracking(self.video_id, delay=self.finished)
+        if ytdl_handle and ytdl_handle.is_running():
+            ytdl_handle.kill()
+        if self.post_download:
+            try:
+                self.post_download(self.video_id, self.download_path, self.finished)
+            except:
+                logger.exception('Post download hook error')
+        self.statestr = 'invalid'
 
     def status(self):
         if self.cleanup:
@@ -330,16 +596,94 @@ class YoutubeLivestreamRecorder:
             f'{self.title} (https://youtu.be/{self.video_id}){schedule_str} [{self.statestr}]'
         ]
 
+class NotificationCache:
+    class Entry:
+        __slots__ = ('last', 'timer', 'args')
+        def __init__(self, last: float):
+            self.last = last
+            self.timer = None
+            self.args = None
+
+    def __init__(
+        self,
+        window: float = 60,
+        ttl: float = 3600,
+        maxsize: int = 4096,
+        loop: Optional[EventLoop] = None,
+    ):
+        self.window = window
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.loop = loop or get_event_loop()
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def admit(self, key, retry, args) -> bool:
+        # repeated notifications within the window are folded into one trailing retry(args)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or now - entry.last >= self.window:
+                self.misses += 1
+                if entry is None:
+                    entry = self.entries[key] = NotificationCache.Entry(now)
+                entry.last = now
+                self.entries.move_to_end(key)
+                self.expire(now)
+                return True
+            self.hits += 1
+            entry.args = args
+            if not entry.timer:
+                entry.timer = self.loop.call_at(entry.last + self.window, self.release, key, retry)
+            return False
+
+    def release(self, key, retry):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return
+            entry.timer = None
+            entry.last = 0
+            args, entry.args = entry.args, None
+        retry(args)
+
+    def expire(self, now: float):
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.maxsize and now - entry.last < self.ttl:
+                break
+            if entry.timer:
+                entry.timer.cancel()
+            del self.entries[key]
+
+
 class YoutubeWebhook:
     def __init__(
         self,
         server_addr: Tuple[str, int],
         webhook_url: str,
+        *,
+        state: Optional[StateStore] = None,
+        notification_window: float = 60,
+        notification_ttl: float = 3600,
+        notification_cache_size: int = 4096,
     ):
         self.webhook_url = webhook_url
+        self.state = state
+        self.notifications = NotificationCache(
+            window=notification_window,
+            ttl=notification_ttl,
+            maxsize=notification_cache_size,
+        )
         self.watchers = {}
         self.lock = threading.RLock()
-        self.server = http.server.HTTPServer(server_addr, self.get_webhook_handler())
+        self.dispatch_queue = queue.Queue()
+        self.dispatch_thread = threading.Thread(target=self.run_dispatch)
+        self.dispatch_thread.start()
+        metrics.queue_depth.add(self.dispatch_queue.qsize, queue='webhook-dispatch')
+        self.server = http.server.ThreadingHTTPServer(server_addr, self.get_webhook_handler())
         self.server_thread = threading.Thread(target=self.server.serve_forever)
         self.server_thread.start()
         self.keep_alive = threading.Thread(target=self.subscribe_keep_alive)
@@ -348,32 +692,47 @@ class YoutubeWebhook:
         logger.info('Started serving youtube webhook')
 
     def subscribe(self, channel_id: str, watcher):
-        resp = requests.post(
+        if self.lease_remaining(channel_id) > 86400:
+            logger.info(f'Subscription to channel {channel_id} is still valid')
+        else:
+            self.renew_subscription(channel_id)
+        with self.lock:
+            if channel_id not in self.watchers:
+                self.watchers[channel_id] = set()
+            self.watchers[channel_id].add(watcher)
+
+    def renew_subscription(self, channel_id: str):
+        resp = get_http_client().post(
             YOUTUBE_FEED_HUB,
+            endpoint='youtube_hub',
             data={
                 'hub.callback': self.webhook_url, 
                 'hub.mode': 'subscribe',
                 'hub.verify': 'sync',
                 'hub.topic': YOUTUBE_CHANNEL_FEED_URL.format(channel_id=channel_id),
-                'hub.lease_seconds': 86400 * 5,
+                'hub.lease_seconds': YOUTUBE_LEASE_SECONDS,
             },
         )
         resp.raise_for_status()
-        with self.lock:
-            if channel_id not in self.watchers:
-                self.watchers[channel_id] = set()
-            self.watchers[channel_id].add(watcher)
+        if self.state:
+            self.state.set('youtube.subscription', channel_id, time.time() + YOUTUBE_LEASE_SECONDS)
         logger.info(f'Subscribed to channel {channel_id}')
 
+    def lease_remaining(self, channel_id: str) -> float:
+        if not self.state:
+            return 0
+        return self.state.get('youtube.subscription', channel_id, 0) - time.time()
+
     def subscribe_keep_alive(self):
         while True:
             time.sleep(86400)
             with self.lock:
                 cids = list(self.watchers.keys())
             for channel_id in cids:
+                if self.lease_remaining(channel_id) > 2 * 86400:
+                    continue
                 try:
-                    with self.lock:
-                        self.subscribe(channel_id, self.watchers[channel_id])
+                    self.renew_subscription(channel_id)
                 except:
                     logger.exception('Re-subscribing error')
                 finally:
@@ -393,23 +752,84 @@ class YoutubeWebhook:
                 self.send_response(400)
                 self.end_headers()
             def do_POST(self):
-                data = self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')
-                logger.debug(data)
-                xmldata = ET.fromstring(data)
-                for entry in xmldata.iter('{http://www.w3.org/2005/Atom}entry'):
-                    video_id = entry.find('{http://www.youtube.com/xml/schemas/2015}videoId').text
-                    channel_id = entry.find('{http://www.youtube.com/xml/schemas/2015}channelId').text
-                    title = entry.find('{http://www.w3.org/2005/Atom}title').text
-                    logger.debug(f'Push notification {video_id}')
-                    with webhook.lock:
-                        if channel_id in webhook.watchers:
-                            for watcher in webhook.watchers[channel_id]:
-                                watcher.watch_video(video_id, title)
-                        else:
-                            pass
+                try:
+                    data = self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')
+                    logger.debug(data)
+                    entries = []
+                    xmldata = ET.fromstring(data)
+                    for entry in xmldata.iter('{http://www.w3.org/2005/Atom}entry'):
+                        video_id = entry.find('{http://www.youtube.com/xml/schemas/2015}videoId').text
+                        channel_id = entry.find('{http://www.youtube.com/xml/schemas/2015}channelId').text
+                        title = entry.find('{http://www.w3.org/2005/Atom}title').text
+                        entries.append((channel_id, video_id, title))
+                except:
+                    logger.exception('Invalid push notification')
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                # acknowledge first, watchers are notified from the dispatch thread
                 self.send_response(200)
                 self.end_headers()
+                for entry in entries:
+                    logger.debug(f'Push notification {entry[1]}')
+                    webhook.dispatch_queue.put(entry)
         return YoutubeWebhookHandler
 
+    def run_dispatch(self):
+        while True:
+            entry = self.dispatch_queue.get()
+            channel_id, video_id, title = entry
+            if not self.notifications.admit(video_id, self.dispatch_queue.put, entry):
+                logger.debug(f'Coalesced push notification {video_id}')
+                continue
+            with self.lock:
+                watchers = list(self.watchers.get(channel_id, ()))
+            for watcher in watchers:
+                try:
+                    watcher.watch_video(video_id, title)
+                except:
+                    logger.exception(f'Failed to dispatch notification {video_id}')
+
     def status(self):
-        return [f'Youtube webhook: {len(self.watchers)} subscribers']
\ No newline at end of file
+        return [
+            f'Youtube webhook: {len(self.watchers)} subscribers, '
+            f'{self.dispatch_queue.qsize()} notifications pending, '
+            f'cache {self.notifications.hits} hits / {self.notifications.misses} misses'
+        ]
+
+
+@profiled('youtube.extract_channel')
+def youtube_extract_channel(channel_data):
+    # single walk over the channel payload: channel title and live/upcoming video renderers
+    name = None
+    videos = []
+    stack = [channel_data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if name is None:
+                metadata = node.get('channelMetadataRenderer')
+                if isinstance(metadata, dict) and 'title' in metadata:
+                    name = metadata['title']
+            if 'videoId' in node and 'thumbnailOverlays' in node:
+                styles = youtube_overlay_styles(node['thumbnailOverlays'])
+                if 'LIVE' in styles or 'UPCOMING' in styles:
+                    videos.append(node)
+            stack.extend(v for v in node.values() if isinstance(v, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(v for v in node if isinstance(v, (dict, list)))
+    return name, videos
+
+def youtube_overlay_styles(overlays):
+    styles = set()
+    stack = [overlays]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            style = node.get('style')
+            if isinstance(style, str):
+                styles.add(style)
+            stack.extend(v for v in node.values() if isinstance(v, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(node)
+    return styles